@@ -0,0 +1,81 @@
+"""IPython extension that skips pip installs that are already satisfied.
+
+process_notebooks.py loads this extension in executing kernels when run with
+--wheelhouse. It also sets PIP_NO_INDEX and PIP_FIND_LINKS, so any pip that
+does run installs from the local wheelhouse, without the network. `%pip install`
+and `!pip install` commands are skipped when every requirement they name is
+already installed in the kernel environment.
+
+"""
+import re
+import shlex
+from importlib import metadata
+
+try:
+    from packaging.requirements import InvalidRequirement, Requirement
+except ImportError:
+    from pip._vendor.packaging.requirements import InvalidRequirement, Requirement
+
+PIP_INSTALL_PATTERN = re.compile(r"^\s*(?:\S*python[\d.]*\s+-m\s+)?pip3?\s+install\s+(.*)$")
+
+# Options that do not change which distributions would be installed
+IGNORED_OPTIONS = {"-q", "-qq", "-qqq", "--quiet", "--no-cache-dir", "--user"}
+
+
+def satisfied(install_args):
+    """Return True if pip install arguments only name installed requirements.
+
+    Anything that cannot be decided (upgrades, requirement files, paths, URLs,
+    extras) is considered unsatisfied, so that pip runs as usual.
+
+    """
+    try:
+        args = shlex.split(install_args)
+    except ValueError:
+        return False
+
+    requirements = [arg for arg in args if arg not in IGNORED_OPTIONS]
+    if not requirements:
+        return False
+
+    for arg in requirements:
+        if arg.startswith("-"):
+            return False
+        try:
+            req = Requirement(arg)
+        except InvalidRequirement:
+            return False
+        if req.url or req.extras:
+            return False
+        if req.marker is not None and not req.marker.evaluate():
+            continue
+        try:
+            version = metadata.version(req.name)
+        except metadata.PackageNotFoundError:
+            return False
+        if not req.specifier.contains(version, prereleases=True):
+            return False
+    return True
+
+
+def load_ipython_extension(ip):
+    """Wrap the %pip magic and shell escapes to skip satisfied installs."""
+    pip_magic = ip.find_line_magic("pip")
+    system = ip.system
+
+    def pip(line):
+        command, _, install_args = line.strip().partition(" ")
+        if command == "install" and satisfied(install_args):
+            print(f"Skipping pip install, requirements already satisfied: {line}")
+            return
+        return pip_magic(line)
+
+    def system_or_skip(cmd):
+        m = PIP_INSTALL_PATTERN.match(cmd)
+        if m is not None and satisfied(m.group(1)):
+            print(f"Skipping pip install, requirements already satisfied: {cmd}")
+            return
+        return system(cmd)
+
+    ip.register_magic_function(pip, "line", "pip")
+    ip.system = system_or_skip
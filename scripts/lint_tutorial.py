@@ -16,10 +16,13 @@ import os
 import io
 import re
 import sys
+import json
+import time
 import argparse
 import tempfile
 import subprocess
 import collections
+import xml.etree.ElementTree as ET
 import nbformat
 from pyflakes.api import check
 from pyflakes.reporter import Reporter
@@ -29,25 +32,52 @@ def main(arglist):
 
     args = parse_args(arglist)
 
-    _, fname = os.path.split(args.path)
+    results = []
+    for path in args.path:
 
-    script, cell_lines = extract_code(args.path)
-    warnings, errors = check_code(script)
-    violations = check_style(script)
+        _, fname = os.path.split(path)
 
-    if args.brief:
-        report_brief(fname, warnings, errors, violations)
-    else:
+        start = time.perf_counter()
+        script, cell_lines = extract_code(path)
+        warnings, errors = check_code(script)
+        style = style_violations(script)
+        seconds = time.perf_counter() - start
+
+        violations = collections.Counter(
+            f"{code} ({message})" for _, _, code, message in style
+        )
         line_map = remap_line_numbers(cell_lines)
-        report_verbose(fname, warnings, errors, violations, line_map)
+
+        if args.json is not None or args.junit is not None:
+            results.append(lint_result(
+                path, seconds, warnings, errors, style, line_map
+            ))
+            warnings.seek(0)
+            errors.seek(0)
+
+        if args.brief:
+            report_brief(fname, warnings, errors, violations)
+        else:
+            report_verbose(fname, warnings, errors, violations, line_map)
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump({"notebooks": results}, f, indent=2)
+    if args.junit is not None:
+        write_junit(args.junit, results)
 
 
 def parse_args(arglist):
 
     parser = argparse.ArgumentParser(__doc__)
-    parser.add_argument("path", help="Path to notebook file")
+    parser.add_argument("path", nargs="+", help="Path to notebook file(s)")
     parser.add_argument("--brief", action="store_true",
                         help="Print brief report (useful for aggregating)")
+    parser.add_argument("--json",
+                        help="Also write the problems and timing for each "
+                             "notebook to this JSON file")
+    parser.add_argument("--junit",
+                        help="Also write a JUnit XML report to this file")
 
     return parser.parse_args(arglist)
 
@@ -57,9 +87,14 @@ def extract_code(nb_fname):
     with open(nb_fname) as f:
         nb = nbformat.read(f, nbformat.NO_CONVERT)
 
+    return cells_to_script(nb.get("cells", []))
+
+
+def cells_to_script(cells):
+    """Join code cells into a script with IPython syntax commented out."""
     script_lines = []
     cell_lengths = []
-    for cell in nb.get("cells", []):
+    for cell in cells:
         if cell["cell_type"] == "code":
             cell_lines = cell.get("source", "").split("\n")
             cell_lengths.append(len(cell_lines))
@@ -86,12 +121,16 @@ def check_code(script):
     return warnings, errors
 
 
-def check_style(script):
-    """Write a temporary script and run pycodestyle (PEP8) on it."""
+def style_violations(script):
+    """Write a temporary script and run pycodestyle (PEP8) on it.
+
+    Returns a list of (line, column, code, message) tuples.
 
+    """
     with tempfile.NamedTemporaryFile("w", suffix=".py") as f:
 
         f.write(script)
+        f.flush()
 
         cmdline = [
             "pycodestyle",
@@ -103,17 +142,16 @@ def check_style(script):
 
     output = res.stdout.decode().replace(f.name, "f").split("\n")
 
-    if not output:
-        return collections.Counter()
-
-    error_classes = []
-    pat = re.compile(r"^f:\d+:\d+: (\w\d{3}) (.*)$")
+    violations = []
+    pat = re.compile(r"^f:(\d+):(\d+): (\w\d{3}) (.*)$")
     for line in output:
         m = pat.match(line)
         if m is not None:
-            error_classes.append(f"{m.group(1)} ({m.group(2)})")
+            violations.append(
+                (int(m.group(1)), int(m.group(2)), m.group(3), m.group(4))
+            )
 
-    return collections.Counter(error_classes)
+    return violations
 
 
 def remap_line_numbers(cell_lines):
@@ -171,20 +209,117 @@ def report_verbose(fname, warnings, errors, violations, line_map):
 
 def reformat_line_problems(stream, line_map, prefix=""):
     """Reformat a pyflakes output stream for notebook cells."""
-    pat = re.compile(r"^\w*:(\d+):\d+ (.+)$")
+    return [
+        f"{prefix}Cell {cell}, Line {line}: {message}"
+        for cell, line, message in line_problems(stream, line_map)
+    ]
+
 
-    new_lines = []
-    orig_lines = stream.read().splitlines()
+def line_problems(stream, line_map):
+    """Parse a pyflakes output stream into (cell, line, message) tuples."""
+    pat = re.compile(r"^\w*:(\d+):\d+:? (.+)$")
 
-    for line in orig_lines:
+    problems = []
+    for line in stream.read().splitlines():
         m = pat.match(line)
         if m:
-            cell, line = line_map[int(m.group(1))]
-            new_lines.append(
-                f"{prefix}Cell {cell}, Line {line}: {m.group(2)}"
-            )
+            cell, line = line_map.get(int(m.group(1)), (None, None))
+            problems.append((cell, line, m.group(2)))
+
+    return problems
+
+
+def test_line_problems():
+
+    warnings, _ = check_code("import os\n\nx = y\n")
+    line_map = remap_line_numbers([2, 2])
+    assert line_problems(warnings, line_map) == [
+        (1, 1, "'os' imported but unused"),
+        (2, 1, "undefined name 'y'"),
+    ]
 
-    return new_lines
+
+def lint_result(path, seconds, warnings, errors, style, line_map):
+    """Collect the problems found in a notebook for machine-readable reports."""
+    _, fname = os.path.split(path)
+    problems = []
+    for kind, stream in [("warning", warnings), ("error", errors)]:
+        for cell, line, message in line_problems(stream, line_map):
+            problems.append(
+                {"kind": kind, "cell": cell, "line": line, "message": message}
+            )
+    style_problems = []
+    for script_line, column, code, message in style:
+        cell, line = line_map.get(script_line, (None, None))
+        style_problems.append({
+            "code": code, "cell": cell, "line": line, "column": column,
+            "message": message,
+        })
+    return {
+        "name": fname,
+        "path": path,
+        "seconds": round(seconds, 3),
+        "problems": problems,
+        "style": style_problems,
+    }
+
+
+def write_junit(fname, results):
+    """Write a JUnit XML report with pyflakes and pycodestyle cases per notebook."""
+    suites = ET.Element("testsuites", name="lint_tutorial")
+    for result in results:
+        checks = [
+            ("pyflakes", [
+                f"Cell {p['cell']}, Line {p['line']}: {p['message']}"
+                for p in result["problems"]
+            ]),
+            ("pycodestyle", [
+                f"Cell {p['cell']}, Line {p['line']}: {p['code']} {p['message']}"
+                for p in result["style"]
+            ]),
+        ]
+        suite = ET.SubElement(
+            suites, "testsuite",
+            name=result["name"],
+            tests=str(len(checks)),
+            failures=str(sum(bool(problems) for _, problems in checks)),
+            time=f"{result['seconds']:.3f}",
+        )
+        for check_name, problems in checks:
+            case = ET.SubElement(
+                suite, "testcase", classname=result["name"], name=check_name
+            )
+            if problems:
+                plural = "" if len(problems) == 1 else "s"
+                failure = ET.SubElement(
+                    case, "failure", message=f"{len(problems)} problem{plural}"
+                )
+                failure.text = "\n".join(problems)
+    ET.ElementTree(suites).write(fname, encoding="utf-8", xml_declaration=True)
+
+
+def test_write_junit(tmp_path):
+
+    results = [
+        {
+            "name": "clean.ipynb", "seconds": 0.5, "problems": [], "style": [],
+        },
+        {
+            "name": "messy.ipynb", "seconds": 1.25,
+            "problems": [{"kind": "warning", "cell": 2, "line": 1,
+                          "message": "undefined name 'y'"}],
+            "style": [],
+        },
+    ]
+    fname = tmp_path / "lint.xml"
+    write_junit(fname, results)
+
+    clean, messy = ET.parse(fname).getroot()
+    assert clean.get("failures") == "0"
+    assert (messy.get("tests"), messy.get("failures")) == ("2", "1")
+    assert messy.get("time") == "1.250"
+    failure, = messy.iter("failure")
+    assert failure.text == "Cell 2, Line 1: undefined name 'y'"
 
 
 if __name__ == "__main__":
@@ -21,16 +21,35 @@
 """
 import os
 import re
+import ast
+import csv
 import sys
+import json
+import time
 import argparse
+import struct
+import signal
 import hashlib
-from io import BytesIO
+import tempfile
+import threading
+import functools
+import collections
+import multiprocessing
+import urllib.request
 from binascii import a2b_base64
-from copy import deepcopy
+from copy import copy, deepcopy
+from concurrent.futures import ThreadPoolExecutor
 
-from PIL import Image
+import yaml
 import nbformat
 from nbconvert.preprocessors import ExecutePreprocessor
+from nbclient.exceptions import CellExecutionError, CellTimeoutError, DeadKernelError
+from nbclient.util import ensure_async, run_sync
+from jupyter_client import AsyncKernelManager, version_info as jupyter_client_version
+from traitlets import Bool, Dict, Float, Int, List, Unicode
+from pyflakes.checker import Checker
+from pyflakes.messages import UndefinedName
+from lint_tutorial import cells_to_script, remap_line_numbers
 
 REPO = os.environ.get("NMA_REPO", "course-content")
 MAIN_BRANCH = os.environ.get("NMA_MAIN_BRANCH", "main")
@@ -42,6 +61,66 @@ GITHUB_TREE_URL = (
     f"https://github.com/NeuromatchAcademy/{REPO}/tree/{MAIN_BRANCH}"
 )
 
+# Directory with kernel-side IPython extensions (download cache and pip wheelhouse)
+KERNEL_SITE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kernel_site")
+
+# Thread pool sizes for BLAS, OpenMP (which also sizes torch's pool), etc.
+THREAD_ENV_VARS = [
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+]
+
+# Major versions of jupyter_client whose (private) kernel launch internals
+# ForkServerKernelManager is known to work with
+FORK_SERVER_JUPYTER_CLIENT_MAJOR = (8,)
+
+# Slot (index, count) of this process's share of the CPUs; see init_worker
+WORKER_SLOT = (0, 1)
+
+# Process IDs of the kernels started by this process that are still running
+RUNNING_KERNELS = set()
+
+# Kernel code to switch rendering of figures (and other images) on or off;
+# matplotlib's inline backend only rasterises a figure when a formatter asks
+RENDER_TOGGLE_CODE = (
+    "[setattr(formatter, 'enabled', {enabled}) for mime, formatter"
+    " in get_ipython().display_formatter.formatters.items()"
+    " if mime in ('image/png', 'image/jpeg', 'image/svg+xml', 'application/pdf')]"
+)
+
+# Kernel code to dump all Python stacks to a file on SIGUSR1, even when stuck
+STACK_DUMP_CODE = (
+    "__import__('faulthandler').register(__import__('signal').SIGUSR1,"
+    " file=open({fname!r}, 'w'), all_threads=True)"
+)
+
+# Note that replaces stream output dropped from the middle of a cell's output
+OMITTED_STREAM_NOTE = "\n[... {} characters of output omitted ...]\n"
+OMITTED_STREAM_PATTERN = re.compile(r"\n\[\.\.\. \d+ characters of output omitted \.\.\.\]\n")
+
+# Anything on a line before a carriage return (not line ending) is overwritten
+CARRIAGE_RETURN_PATTERN = re.compile(r".*\r(?=[^\n])")
+
+# Bytes read at a time when prefetching downloads
+DOWNLOAD_CHUNK_SIZE = 2 ** 20
+
+# Literal http(s) URLs in code, which may be followed by f-string fields
+DOWNLOAD_URL_PATTERN = re.compile(r"https?://[^\s'\"<>(){}\[\]\\]+")
+
+# Titles of video, slide and feedback cells, which add nothing to QC
+WIDGET_TITLE_PATTERNS = ["video", "slides", "submit your feedback"]
+
+# Names that an IPython kernel defines beyond the Python builtins
+IPYTHON_BUILTINS = {"get_ipython", "display", "In", "Out", "_", "__", "___"}
+
+# IPython syntax that binds a name: `%%capture [options] name` (at the start
+# of a cell) and `name = %magic ...` or `name = !command ...`
+CAPTURE_MAGIC_PATTERN = re.compile(r"\A%%capture\b(?:[ \t]+-\S+)*[ \t]+(\w+).*$", re.M)
+MAGIC_ASSIGNMENT_PATTERN = re.compile(r"^([ \t]*\w+)[ \t]*=[ \t]*[%!].*$", re.M)
+
 
 def main(arglist):
     """Process IPython notebooks from a list of files."""
@@ -60,6 +139,12 @@ def main(arglist):
         ])
 
     nb_paths = [arg for arg in args.files if should_process(arg)]
+
+    # Only process this job's share of the notebooks when CI is split up
+    timings = load_timings(args.timings)
+    if args.shard is not None:
+        nb_paths = shard_notebooks(nb_paths, args.shard, timings)
+
     if not nb_paths:
         print("No notebook files found")
         sys.exit(0)
@@ -72,51 +157,106 @@ def main(arglist):
     if "NB_KERNEL" in os.environ:
         exec_kws["kernel_name"] = os.environ["NB_KERNEL"]
 
+    # Leave out cells that only do network or widget work
+    exec_kws["skip_tags"] = args.skip_tags or []
+    exec_kws["skip_titles"] = args.skip_titles or []
+    if args.skip_widgets:
+        exec_kws["skip_titles"] += WIDGET_TITLE_PATTERNS
+
+    # Override the parameters cell, e.g. to train for fewer epochs in CI
+    parameters = {}
+    if args.parameters_file is not None:
+        with open(args.parameters_file) as f:
+            parameters.update(yaml.safe_load(f) or {})
+    parameters.update(args.parameters or [])
+    if parameters:
+        exec_kws["parameters"] = parameters
+
+    # Serve the downloads of executing kernels from a local cache
+    kernel_env = {}
+    kernel_extensions = []
+    if args.download_cache is not None:
+        kernel_env.update(download_cache_env(args.download_cache))
+        kernel_extensions.append("download_cache")
+
+    # Install packages from a local wheelhouse, skipping satisfied requirements
+    if args.wheelhouse is not None:
+        kernel_env.update(wheelhouse_env(args.wheelhouse))
+        kernel_extensions.append("pip_wheelhouse")
+
+    if kernel_env:
+        exec_kws["kernel_env"] = kernel_env
+    if kernel_extensions:
+        exec_kws["extra_arguments"] = [
+            f"--IPKernelApp.extensions={name}" for name in kernel_extensions
+        ]
+
+    # Bound the stream output (e.g. training progress) kept for each cell
+    if args.coalesce_streams:
+        exec_kws["merge_streams"] = True
+    if args.max_stream_chars is not None:
+        exec_kws["max_stream_chars"] = args.max_stream_chars
+
+    # Kill kernels that hang instead of waiting for the timeout
+    if args.hang_timeout is not None:
+        exec_kws["hang_timeout"] = args.hang_timeout
+
+    # Keep one runaway notebook from taking down the rest of the runner
+    if args.max_memory is not None:
+        exec_kws["memory_limit"] = args.max_memory
+    if args.max_cpu_time is not None:
+        exec_kws["cpu_time_limit"] = args.max_cpu_time
+
+    # Save kernel state at section headers and resume from unchanged sections
+    if args.checkpoint_dir is not None:
+        exec_kws["checkpoint_dir"] = args.checkpoint_dir
+        exec_kws["checkpoint_deps"] = args.cache_deps or ["requirements.txt"]
+
+    # Fork kernels from a server that has already imported the prelude
+    if args.kernel_prelude is not None:
+        if jupyter_client_version[0] not in FORK_SERVER_JUPYTER_CLIENT_MAJOR:
+            sys.exit(
+                "--kernel-prelude relies on jupyter_client internals and is only "
+                f"supported with jupyter_client {FORK_SERVER_JUPYTER_CLIENT_MAJOR}.x"
+            )
+        prelude = [mod for mod in args.kernel_prelude.split(",") if mod]
+        configure_kernel_fork_server(prelude)
+        exec_kws["kernel_manager_class"] = ForkServerKernelManager
+
     # Defer failures until after processing all notebooks
     notebooks = {}
     errors = {}
 
-    for nb_path in nb_paths:
-
-        # Load the notebook structure
-        with open(nb_path) as f:
-            nb = nbformat.read(f, nbformat.NO_CONVERT)
-
-        if not sequentially_executed(nb):
-            if args.require_sequential:
-                err = (
-                    "Notebook is not sequentially executed on a fresh kernel."
-                    "\n"
-                    "Please do 'Restart and run all' before pushing to Github."
-                )
-                errors[nb_path] = err
-                continue
-
-        # Clean whitespace from all code cells
-        clean_whitespace(nb)
-
-        # Ensure that we have an executed notebook, in one of two ways
-        executor = ExecutePreprocessor(**exec_kws)
-        if args.execute:
-            # Check dynamically by executing and reporting errors
-            print(f"Executing {nb_path}")
-            error = execute_notebook(executor, nb, args.raise_fast)
-        elif args.check_execution:
-            # Check statically by examining the cell outputs
-            print(f"Checking {nb_path} execution")
-            error = check_execution(executor, nb, args.raise_fast)
-        else:
-            error = None
-
+    if args.jobs > 1:
+        results = run_parallel(nb_paths, args, exec_kws)
+    else:
+        results = (check_notebook(nb_path, args, exec_kws) for nb_path in nb_paths)
+
+    profile = []
+    runtimes = {}
+    for nb_path, (nb, error, nb_profile, runtime) in zip(nb_paths, results):
+        profile.extend(nb_profile)
+        if runtime is not None:
+            runtimes[nb_path] = runtime
         if error is None:
             notebooks[nb_path] = nb
         else:
             errors[nb_path] = error
 
+    if args.profile is not None:
+        write_profile(profile, args.profile)
+
+    # Record how long each fully executed notebook took, for future sharding
+    if args.timings is not None and runtimes:
+        timings.update(runtimes)
+        with open(args.timings, "w") as f:
+            json.dump(timings, f, indent=1, sort_keys=True)
+
     if errors or args.check_only:
-        exit(errors)
+        exit(errors, profile, args.n_slowest)
 
-    # Post-process notebooks
+    # Post-process notebooks, only touching files whose contents change
+    write_counts = collections.Counter()
     for nb_path, nb in notebooks.items():
 
         # Extract components of the notebook path
@@ -135,9 +275,8 @@ def main(arglist):
 
         # Write the original notebook back to disk, clearing outputs only for tutorials
         print(f"Writing complete notebook to {nb_path}")
-        with open(nb_path, "w") as f:
-            nb_clean = clean_notebook(nb, clear_outputs=nb_path.startswith("tutorials"))
-            nbformat.write(nb_clean, f)
+        nb_clean = clean_notebook(nb, clear_outputs=nb_path.startswith("tutorials"))
+        write_artifacts({nb_path: serialize_notebook(nb_clean)}, write_counts)
 
         # if the notebook is not in tutorials, skip the creation/update of the student, static, solutions directories
         if not nb_path.startswith("tutorials"):
@@ -158,52 +297,976 @@ def main(arglist):
         print(f"Create instructor notebook from {nb_path}")
         instructor_nb = instructor_version(nb, nb_dir, nb_name)
 
+        # Clean both versions; this gives each its own copy of every cell,
+        # while the versions above share the cells they did not modify
+        clean_student_nb = clean_notebook(student_nb)
+        clean_instructor_nb = clean_notebook(instructor_nb)
+
         # Loop through cells and point the colab badge at the student version
-        for cell in student_nb.get("cells", []):
+        for cell in clean_student_nb.get("cells", []):
             if has_colab_badge(cell):
                 redirect_colab_badge_to_student_version(cell)
                 # add kaggle badge
                 add_kaggle_badge(cell, nb_path)
 
         # Loop through cells and point the colab badge at the instructor version
-        for cell in instructor_nb.get("cells", []):
+        for cell in clean_instructor_nb.get("cells", []):
             if has_colab_badge(cell):
                 redirect_colab_badge_to_instructor_version(cell)
                 # add kaggle badge
                 add_kaggle_badge(cell, nb_path)
 
+        # Collect the files to write, then write them across a thread pool
+        artifacts = {}
+
         # Write the student version of the notebook
         student_nb_path = os.path.join(student_dir, nb_fname)
         print(f"Writing student notebook to {student_nb_path}")
-        with open(student_nb_path, "w") as f:
-            clean_student_nb = clean_notebook(student_nb)
-            nbformat.write(clean_student_nb, f)
+        artifacts[student_nb_path] = serialize_notebook(clean_student_nb)
 
         # Write the images extracted from the solution cells
         print(f"Writing solution images to {static_dir}")
-        for fname, image in static_images.items():
+        for fname, image_data in static_images.items():
             fname = fname.replace("static", static_dir)
-            image.save(fname)
+            artifacts[fname] = image_data
 
         # Write the solution snippets
         print(f"Writing solution snippets to {solutions_dir}")
         for fname, snippet in solution_snippets.items():
             fname = fname.replace("solutions", solutions_dir)
-            with open(fname, "w") as f:
-                f.write(snippet)
+            artifacts[fname] = snippet
 
         # Write the instructor version of the notebook
         instructor_nb_path = os.path.join(instructor_dir, nb_fname)
         print(f"Writing instructor notebook to {instructor_nb_path}")
-        with open(instructor_nb_path, "w") as f:
-            clean_instructor_nb = clean_notebook(instructor_nb)
-            nbformat.write(clean_instructor_nb, f)
+        artifacts[instructor_nb_path] = serialize_notebook(clean_instructor_nb)
 
-    exit(errors)
+        write_artifacts(artifacts, write_counts)
+
+    print(
+        f"Wrote {write_counts['written']} file(s), "
+        f"skipped {write_counts['unchanged']} unchanged file(s)"
+    )
+    exit(errors, profile, args.n_slowest)
 
 
 # ------------------------------------------------------------------------------------ #
 
+def check_notebook(nb_path, args, exec_kws):
+    """Load, check and (optionally) execute a notebook.
+
+    Returns the notebook, the error (or None), the per-cell execution profile
+    and the runtime of a complete execution (or None).
+
+    """
+    # Load the notebook structure; static QC only needs a light version of it
+    if args.check_only and not args.execute:
+        nb = read_notebook_for_checks(nb_path)
+    else:
+        with open(nb_path) as f:
+            nb = nbformat.read(f, nbformat.NO_CONVERT)
+
+    if not sequentially_executed(nb):
+        if args.require_sequential:
+            err = (
+                "Notebook is not sequentially executed on a fresh kernel."
+                "\n"
+                "Please do 'Restart and run all' before pushing to Github."
+            )
+            return nb, err, [], None
+
+    # Clean whitespace from all code cells
+    clean_whitespace(nb)
+
+    # Ensure that we have an executed notebook, in one of two ways
+    executor = NotebookExecutor(**exec_kws)
+
+    # Tutorial outputs are discarded, apart from the solution images
+    executor.fast_render = args.fast_render and nb_path.startswith("tutorials")
+
+    # Run on this worker's share of the CPUs, with thread pools to match
+    if args.pin_cpus and args.execute:
+        threads = nb.get("metadata", {}).get("nmaci", {}).get("threads")
+        executor.cpu_set = kernel_cpus(*WORKER_SLOT, threads=threads)
+        n_threads = str(len(executor.cpu_set))
+        executor.kernel_env = {
+            **executor.kernel_env, **{var: n_threads for var in THREAD_ENV_VARS}
+        }
+    if args.execute:
+        # Reuse the outputs of a previous execution when the code is unchanged
+        cache_key = None
+        if args.cache_dir is not None:
+            kernel_name = (
+                exec_kws.get("kernel_name")
+                or nb.metadata.get("kernelspec", {}).get("name", "")
+            )
+            cache_deps = args.cache_deps or ["requirements.txt"]
+            cache_key = execution_cache_key(
+                nb, kernel_name, cache_deps, exec_kws.get("parameters"),
+                executor.output_options(),
+            )
+        if cache_key and load_cached_outputs(nb, args.cache_dir, cache_key):
+            print(f"Using cached execution of {nb_path}", flush=True)
+            return nb, None, [], None
+
+        # Reject notebooks that would fail on an undefined name, without a kernel
+        if args.preflight:
+            undefined = find_undefined_names(
+                nb, exec_kws.get("allow_error_names", ()), executor.skips_cell
+            )
+            if undefined:
+                return nb, "\n".join(undefined), [], None
+
+        # Fetch the datasets that the notebook downloads before starting it
+        if args.download_cache is not None:
+            prefetch_downloads(nb, args.download_cache, executor.skips_cell)
+
+        # Check dynamically by executing and reporting errors
+        print(f"Executing {nb_path}", flush=True)
+        error = execute_notebook(executor, nb, args.raise_fast)
+        if error is None and cache_key:
+            store_cached_outputs(nb, args.cache_dir, cache_key)
+    elif args.check_execution:
+        # Check statically by examining the cell outputs
+        print(f"Checking {nb_path} execution", flush=True)
+        error = check_execution(executor, nb, args.raise_fast)
+    else:
+        error = None
+
+    profile = [dict(notebook=nb_path, **row) for row in executor.cell_profile]
+
+    # Only complete, successful runs are representative for sharding
+    runtime = None
+    if args.execute and error is None and executor.executed_all_cells():
+        runtime = round(sum(row["wall_time"] for row in profile), 3)
+
+    return nb, error, profile, runtime
+
+
+def run_parallel(nb_paths, args, exec_kws):
+    """Check notebooks in a pool of worker processes, one kernel per worker.
+
+    Results are returned in the order of nb_paths. With --raise-fast, the first
+    exception raised by a worker terminates the workers and their kernels.
+
+    """
+    n_workers = min(args.jobs, len(nb_paths))
+
+    # Give each worker a slot, which determines the CPUs its kernels run on
+    slots = multiprocessing.Queue()
+    for slot in range(n_workers):
+        slots.put((slot, n_workers))
+
+    pool = multiprocessing.Pool(n_workers, initializer=init_worker, initargs=(slots,))
+    check = functools.partial(check_indexed_notebook, args=args, exec_kws=exec_kws)
+    results = [None] * len(nb_paths)
+    try:
+        # Re-raise worker exceptions (only escape the worker with --raise-fast)
+        for i, result in pool.imap_unordered(check, enumerate(nb_paths)):
+            results[i] = result
+    except BaseException:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    return results
+
+
+def check_indexed_notebook(indexed_path, args, exec_kws):
+    """Check a notebook in a worker, returning its index with the result."""
+    i, nb_path = indexed_path
+    return i, check_notebook(nb_path, args, exec_kws)
+
+
+def init_worker(slots):
+    """Claim a CPU slot for this worker process and kill kernels on terminate."""
+    global WORKER_SLOT
+    WORKER_SLOT = slots.get()
+    signal.signal(signal.SIGTERM, terminate_worker)
+
+    # Pool workers are daemons, which cannot start (forked) kernel processes
+    multiprocessing.current_process().daemon = False
+
+
+def terminate_worker(signum, frame):
+    """Kill the kernels running in this worker, then exit."""
+    for pid in list(RUNNING_KERNELS):
+        kill_process_group(pid)
+    os._exit(128 + signum)
+
+
+def kill_process_group(pid):
+    """Kill a process, and its process group if it leads one."""
+    try:
+        if os.getpgid(pid) == pid:
+            os.killpg(pid, signal.SIGKILL)
+        else:
+            os.kill(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def kernel_cpus(slot, n_slots, threads=None):
+    """Return the CPUs for a kernel in one of n_slots equal shares of ours.
+
+    A kernel that asks for more threads than its share overlaps the next ones.
+
+    """
+    cpus = sorted(os.sched_getaffinity(0))
+    share = max(len(cpus) // n_slots, 1)
+    start = slot * share
+    return [cpus[(start + i) % len(cpus)] for i in range(min(threads or share, len(cpus)))]
+
+
+def test_kernel_cpus():
+
+    n = len(os.sched_getaffinity(0))
+    assert len(kernel_cpus(0, 1)) == n
+    assert len(kernel_cpus(1, 2)) == max(n // 2, 1)
+    assert len(kernel_cpus(1, 2, threads=n + 1)) == n
+
+
+class NotebookExecutor(ExecutePreprocessor):
+    """ExecutePreprocessor that records wall time and kernel memory per cell.
+
+    Optionally, the kernel state is saved with dill at section headers, and a
+    later run resumes from the last checkpoint whose preceding code cells are
+    unchanged (restoring their outputs rather than executing them).
+
+    With a hang timeout, a watchdog thread kills the kernel when a cell has
+    neither produced output nor used CPU for that long, and reports the cell
+    together with the kernel's Python stacks. The same thread enforces memory
+    and CPU time budgets for the kernel and its subprocesses.
+
+    """
+    checkpoint_dir = Unicode(
+        None, allow_none=True,
+        help="Directory for kernel state checkpoints; None disables them.",
+    ).tag(config=True)
+
+    checkpoint_deps = List(
+        Unicode(),
+        help="Files whose contents invalidate the kernel state checkpoints.",
+    ).tag(config=True)
+
+    checkpoint_pattern = Unicode(
+        r"^# ",
+        help="Regex (multiline) identifying markdown cells to checkpoint before.",
+    ).tag(config=True)
+
+    fast_render = Bool(
+        False,
+        help="Disable image formatters in the kernel for cells other than "
+             "solutions, so figures whose outputs are discarded are not rendered.",
+    ).tag(config=True)
+
+    skip_tags = List(
+        Unicode(),
+        help="Tags (besides skip_cells_with_tag) of cells to leave unexecuted.",
+    ).tag(config=True)
+
+    skip_titles = List(
+        Unicode(),
+        help="Regexes (case-insensitive) for the @title of cells to leave unexecuted.",
+    ).tag(config=True)
+
+    parameters = Dict(
+        help="Values to override in the cell tagged 'parameters' (papermill-style).",
+    ).tag(config=True)
+
+    kernel_env = Dict(
+        help="Environment variables to set for the kernel, on top of ours.",
+    ).tag(config=True)
+
+    hang_timeout = Float(
+        None, allow_none=True,
+        help="Seconds without output or kernel CPU use after which a cell is "
+             "considered hung and the kernel is killed; None disables this.",
+    ).tag(config=True)
+
+    memory_limit = Float(
+        None, allow_none=True,
+        help="Resident memory budget (MB) for the kernel and its subprocesses.",
+    ).tag(config=True)
+
+    cpu_time_limit = Float(
+        None, allow_none=True,
+        help="CPU time budget (s) for the kernel and its subprocesses.",
+    ).tag(config=True)
+
+    cpu_set = List(
+        Int(),
+        help="CPUs to pin the kernel (all of its threads) to; empty to not pin.",
+    ).tag(config=True)
+
+    merge_streams = Bool(
+        False,
+        help="Merge consecutive stream outputs as they arrive. Unlike nbclient's "
+             "coalesce_streams, this never moves outputs that display IDs refer to.",
+    ).tag(config=True)
+
+    max_stream_chars = Int(
+        None, allow_none=True,
+        help="Maximum characters of stream output kept per cell (head and tail).",
+    ).tag(config=True)
+
+    cell_profile = ()
+
+    def preprocess(self, nb, resources=None, km=None):
+        self.cell_profile = []
+        self.resume_index = 0
+        self.skipped_cells = 0
+        self.render_suppressed = False
+        self.watched_cell = None
+        self.kill_report = None
+        self.last_usage = (None, None)
+        self.peak_rss = None
+        self.kernel_pid = None
+
+        # Watch for hung or over-budget cells from a separate thread
+        monitored = any(
+            limit is not None
+            for limit in [self.hang_timeout, self.memory_limit, self.cpu_time_limit]
+        )
+        if monitored:
+            fd, self.stacks_file = tempfile.mkstemp(prefix="kernel-stacks-", suffix=".txt")
+            os.close(fd)
+            stop_monitor = threading.Event()
+            monitor = threading.Thread(
+                target=self.monitor_kernel, args=(stop_monitor,), daemon=True
+            )
+            monitor.start()
+
+        # Run with overridden parameters, but leave the notebook as authored
+        injected = inject_parameters(nb, self.parameters)
+        try:
+            return super().preprocess(nb, resources, km)
+        except DeadKernelError:
+            if self.kill_report is not None:
+                raise self.kill_report from None
+            if self.cpu_time_limit is not None:
+                # The CPU rlimit may have killed the kernel between samples
+                cpu, rss = self.last_usage
+                raise DeadKernelError(
+                    f"Kernel died, possibly at its CPU time rlimit "
+                    f"(last sampled usage: {cpu} s CPU, {rss} MB)"
+                ) from None
+            raise
+        finally:
+            RUNNING_KERNELS.discard(self.kernel_pid)
+            if self.max_stream_chars is not None:
+                # Later cells can update displays by their output index, so the
+                # streams emptied by truncation are only dropped at the end
+                for cell in nb.cells:
+                    if cell["cell_type"] == "code":
+                        cell.outputs = [
+                            out for out in cell.outputs
+                            if out["output_type"] != "stream" or out["text"]
+                        ]
+            if monitored:
+                stop_monitor.set()
+                monitor.join()
+                os.remove(self.stacks_file)
+            if injected is not None:
+                del nb.cells[injected]
+                for row in self.cell_profile:
+                    if row["cell"] > injected:
+                        row["cell"] -= 1
+
+    def preprocess_cell(self, cell, resources, index):
+        if self.hang_timeout is not None and index == 0:
+            self.run_kernel_code(STACK_DUMP_CODE.format(fname=self.stacks_file))
+
+        if self.checkpoint_dir is not None:
+            if index == 0:
+                self.resume_from_checkpoint()
+            if index < self.resume_index:
+                return cell, self.resources
+            if index > self.resume_index and self.is_checkpoint(cell):
+                self.save_checkpoint(index)
+
+        if cell["cell_type"] != "code" or not cell["source"].strip():
+            return super().preprocess_cell(cell, resources, index)
+
+        # Keep the existing outputs of cells excluded by the skip policy
+        if self.skips_cell(cell):
+            self.skipped_cells += 1
+            return cell, self.resources
+
+        if self.fast_render:
+            self.set_render_suppressed(not has_solution(cell))
+
+        # Record the cell even if it fails or times out, as that is often
+        # the one we are most interested in
+        start = time.perf_counter()
+        start_cpu, _ = process_tree_usage(kernel_pid(self.km))
+        self.last_activity = time.monotonic()
+        self.watched_cell = index
+        self.stream_growth = self.stream_omitted = 0
+        try:
+            return super().preprocess_cell(cell, resources, index)
+        finally:
+            self.watched_cell = None
+            if self.max_stream_chars is not None:
+                self.stream_omitted = truncate_streams(
+                    cell.outputs, self.max_stream_chars, self.stream_omitted
+                )
+            end_cpu, _ = process_tree_usage(kernel_pid(self.km))
+            if end_cpu is None:
+                # The kernel has been killed; use the monitor's last sample
+                end_cpu, _ = self.last_usage
+            cpu_time = None
+            if None not in (start_cpu, end_cpu):
+                cpu_time = round(end_cpu - start_cpu, 2)
+            # Subprocesses are only included when the kernel is monitored
+            peak_rss = kernel_peak_rss(self.km)
+            if self.peak_rss is not None:
+                peak_rss = max(peak_rss or 0, self.peak_rss)
+            first_line, *_ = cell["source"].strip().splitlines()
+            self.cell_profile.append({
+                "cell": index,
+                "wall_time": round(time.perf_counter() - start, 3),
+                "cpu_time": cpu_time,
+                "peak_rss_mb": peak_rss,
+                "first_line": first_line[:80],
+            })
+
+    def process_message(self, msg, cell, cell_index):
+        self.last_activity = time.monotonic()
+        return super().process_message(msg, cell, cell_index)
+
+    def output(self, outs, msg, display_id, cell_index):
+        if msg["msg_type"] != "stream":
+            return super().output(outs, msg, display_id, cell_index)
+
+        # Merge into the previous output as it arrives, rather than at the end
+        last = outs[-1] if outs else None
+        parent_msg_id = msg["parent_header"].get("msg_id")
+        text = msg["content"]["text"]
+        if (
+            self.merge_streams
+            and last is not None
+            and last["output_type"] == "stream"
+            and last["name"] == msg["content"]["name"]
+            and not self.output_hook_stack[parent_msg_id]
+            and not self.clear_before_next_output
+        ):
+            if "\r" in text:
+                # Apply carriage returns (e.g. from tqdm) to the last line
+                line_start = last["text"].rfind("\n") + 1
+                line = CARRIAGE_RETURN_PATTERN.sub("", last["text"][line_start:] + text)
+                last["text"] = last["text"][:line_start] + line
+            else:
+                last["text"] += text
+            out = last
+        else:
+            out = super().output(outs, msg, display_id, cell_index)
+
+        # Bound the memory used by long-running cells that print a lot
+        self.stream_growth += len(text)
+        if self.max_stream_chars is not None and self.stream_growth > self.max_stream_chars:
+            self.stream_omitted = truncate_streams(
+                outs, self.max_stream_chars, self.stream_omitted
+            )
+            self.stream_growth = 0
+        return out
+
+    def monitor_kernel(self, stop):
+        """Kill the kernel if the running cell hangs or goes over budget."""
+        interval = 1 if self.hang_timeout is None else min(self.hang_timeout / 4, 5)
+        last_cpu = None
+        while not stop.wait(interval):
+            pid = kernel_pid(self.km)
+            index = self.watched_cell
+            if pid is None or index is None:
+                last_cpu = None
+                continue
+
+            cpu, rss = process_tree_usage(pid)
+            self.last_usage = cpu, rss
+            if rss is not None:
+                self.peak_rss = max(self.peak_rss or 0, rss)
+            if None not in (self.memory_limit, rss) and rss > self.memory_limit:
+                reason = f"went over the memory budget ({rss:.0f} > {self.memory_limit:g} MB)"
+                report = self.kill_kernel(pid, index, reason)
+                self.kill_report = CellExecutionError(report, "MemoryError", reason)
+                return
+            if None not in (self.cpu_time_limit, cpu) and cpu > self.cpu_time_limit:
+                reason = f"went over the CPU time budget ({cpu:.1f} > {self.cpu_time_limit:g} s)"
+                report = self.kill_kernel(pid, index, reason)
+                self.kill_report = CellExecutionError(report, "CPUTimeExceeded", reason)
+                return
+            if self.hang_timeout is None:
+                continue
+
+            # Count the kernel as busy if it used a few percent of a CPU
+            if None not in (cpu, last_cpu) and cpu - last_cpu > 0.05 * interval:
+                self.last_activity = time.monotonic()
+            last_cpu = cpu
+
+            idle = time.monotonic() - self.last_activity
+            if idle > self.hang_timeout:
+                reason = f"hung: no output and no kernel CPU use for {idle:.0f} s"
+                report = self.kill_kernel(pid, index, reason, dump_stacks=True)
+                self.kill_report = CellTimeoutError(report)
+                return
+
+    def kill_kernel(self, pid, index, reason, dump_stacks=False):
+        """Kill the kernel (optionally dumping its stacks) and describe why."""
+        try:
+            if dump_stacks:
+                os.kill(pid, signal.SIGUSR1)
+                time.sleep(1)
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+        first_line, *_ = self.nb.cells[index]["source"].strip().splitlines()
+        report = f"Cell {index} {reason}, so the kernel was killed.\n{first_line[:80]}"
+        if dump_stacks:
+            with open(self.stacks_file) as f:
+                stacks = f.read().strip() or "(no stacks were written)"
+            report += f"\n\nKernel stacks:\n{stacks}"
+        return report
+
+    def apply_kernel_limits(self):
+        """Pin a newly started kernel and set OS-level backstops for the budgets.
+
+        The monitor thread samples usage, so a kernel that exceeds its CPU
+        budget between samples is stopped by RLIMIT_CPU. Linux ignores
+        RLIMIT_RSS, so for memory the kernel instead becomes the preferred
+        victim of the OOM killer, rather than this script or other kernels.
+
+        """
+        pid = kernel_pid(self.km)
+        if pid is None:
+            return
+        if self.cpu_set:
+            # Threads started before now do not inherit the affinity
+            for task in os.listdir(f"/proc/{pid}/task"):
+                os.sched_setaffinity(int(task), self.cpu_set)
+        if self.cpu_time_limit is not None:
+            limit = int(self.cpu_time_limit) + 5
+            try:
+                import resource  # Unix only
+                resource.prlimit(pid, resource.RLIMIT_CPU, (limit, limit))
+            except (ImportError, OSError, AttributeError) as error:
+                self.log.warning("Could not limit kernel CPU time: %s", error)
+        if self.memory_limit is not None:
+            try:
+                with open(f"/proc/{pid}/oom_score_adj", "w") as f:
+                    f.write("1000")
+            except OSError as error:
+                self.log.warning("Could not adjust kernel OOM score: %s", error)
+
+    async def async_run_kernel_code(self, code):
+        """Run code silently in the kernel, returning an error message or None."""
+        reply = await ensure_async(self.kc.execute_interactive(
+            code, silent=True, store_history=False,
+            timeout=self.timeout, output_hook=lambda msg: None,
+        ))
+        content = reply["content"]
+        if content["status"] == "error":
+            return f"{content['ename']}: {content['evalue']}"
+
+    run_kernel_code = run_sync(async_run_kernel_code)
+
+    async def async_start_new_kernel(self, **kwargs):
+        if self.kernel_env:
+            kwargs["env"] = {**kwargs.get("env", os.environ), **self.kernel_env}
+        await super().async_start_new_kernel(**kwargs)
+        self.kernel_pid = kernel_pid(self.km)
+        if self.kernel_pid is not None:
+            RUNNING_KERNELS.add(self.kernel_pid)
+        self.apply_kernel_limits()
+
+    start_new_kernel = run_sync(async_start_new_kernel)
+
+    def executed_all_cells(self):
+        """Return True if the last run neither resumed nor skipped any cells."""
+        return self.resume_index == 0 and not self.skipped_cells
+
+    def output_options(self):
+        """Return the settings that change which outputs are produced."""
+        return {
+            "skip_tags": [self.skip_cells_with_tag, *self.skip_tags],
+            "skip_titles": list(self.skip_titles),
+            "fast_render": self.fast_render,
+            "merge_streams": self.merge_streams,
+            "max_stream_chars": self.max_stream_chars,
+        }
+
+    def skips_cell(self, cell):
+        """Return True if the skip policy excludes the cell from execution."""
+        tags = cell.get("metadata", {}).get("tags", [])
+        if any(tag in tags for tag in [self.skip_cells_with_tag, *self.skip_tags]):
+            return True
+        m = re.match(r"#\s*@title(.*)", cell["source"])
+        return m is not None and any(
+            re.search(pattern, m.group(1), re.I) for pattern in self.skip_titles
+        )
+
+    def set_render_suppressed(self, suppress):
+        """Toggle the kernel's image formatters, if not already in that state."""
+        if suppress == self.render_suppressed:
+            return
+        error = self.run_kernel_code(RENDER_TOGGLE_CODE.format(enabled=not suppress))
+        if error is not None:
+            # Not an IPython kernel (or a broken one); just render everything
+            self.log.warning("Could not toggle figure rendering: %s", error)
+            self.fast_render = False
+            return
+        self.render_suppressed = suppress
+
+    def is_checkpoint(self, cell):
+        """Return True if kernel state should be saved before this cell."""
+        return (
+            cell["cell_type"] == "markdown"
+            and re.search(self.checkpoint_pattern, cell["source"], re.M) is not None
+        )
+
+    def checkpoint_path(self, index):
+        """Return the checkpoint path (without extension) for state before a cell.
+
+        The path is keyed on the kernel, the dependency files and all code (and
+        cell tags) before the cell, like the execution cache.
+
+        """
+        key = hashlib.sha1(self.kernel_name.encode("utf-8"))
+        update_dep_files_key(key, self.checkpoint_deps)
+        update_code_cells_key(key, self.nb.cells[:index])
+        return os.path.abspath(os.path.join(self.checkpoint_dir, key.hexdigest()))
+
+    def save_checkpoint(self, index):
+        """Save the kernel session and the outputs of all cells before index."""
+        path = self.checkpoint_path(index)
+        if os.path.exists(f"{path}.json"):
+            return
+
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        error = self.run_kernel_code(f"import dill; dill.dump_session({path + '.pkl'!r})")
+        if error is not None:
+            # State that cannot be serialized just means no checkpoint here
+            self.log.warning("Could not checkpoint before cell %s: %s", index, error)
+            if os.path.exists(f"{path}.pkl"):
+                os.remove(f"{path}.pkl")
+            return
+
+        cells = [
+            {"outputs": cell["outputs"], "execution_count": cell["execution_count"]}
+            for cell in self.nb.cells[:index] if cell["cell_type"] == "code"
+        ]
+        with open(f"{path}.json", "w") as f:
+            json.dump(cells, f)
+
+    def resume_from_checkpoint(self):
+        """Load the latest valid checkpoint into the kernel and restore outputs."""
+        checkpoints = [
+            index for index, cell in enumerate(self.nb.cells)
+            if index and self.is_checkpoint(cell)
+        ]
+        for index in reversed(checkpoints):
+            path = self.checkpoint_path(index)
+            if os.path.exists(f"{path}.json") and os.path.exists(f"{path}.pkl"):
+                break
+        else:
+            return
+
+        error = self.run_kernel_code(f"import dill; dill.load_session({path + '.pkl'!r})")
+        if error is not None:
+            # Fall back to a full run on a clean namespace
+            self.log.warning("Could not resume from cell %s: %s", index, error)
+            self.run_kernel_code("get_ipython().reset(new_session=False)")
+            return
+
+        with open(f"{path}.json") as f:
+            cached_cells = nbformat.from_dict(json.load(f))
+        code_cells = [cell for cell in self.nb.cells[:index] if cell["cell_type"] == "code"]
+        for cell, cached_cell in zip(code_cells, cached_cells):
+            cell["outputs"] = cached_cell["outputs"]
+            cell["execution_count"] = cached_cell["execution_count"]
+
+        print(f"Resuming execution from checkpoint before cell {index}", flush=True)
+        self.resume_index = index
+
+
+def truncate_streams(outputs, max_chars, omitted=0):
+    """Keep the head and tail of a cell's stream text, max_chars in total.
+
+    Other outputs (errors, images, etc.) are untouched. Stream outputs in the
+    middle are emptied rather than removed, as display IDs index into the
+    outputs. A note of how many characters were omitted (including by earlier
+    calls, whose notes it replaces) marks the cut. Returns that total.
+
+    """
+    streams = [out for out in outputs if out["output_type"] == "stream"]
+    total = sum(len(out["text"]) for out in streams)
+    if total <= max_chars + (omitted and len(OMITTED_STREAM_NOTE.format(omitted))):
+        return omitted
+
+    for out in streams:
+        out["text"] = OMITTED_STREAM_PATTERN.sub("", out["text"])
+    total = sum(len(out["text"]) for out in streams)
+    if total <= max_chars:
+        return omitted
+
+    head_end = max_chars // 2
+    tail_start = total - (max_chars - head_end)
+    omitted += tail_start - head_end
+    note = OMITTED_STREAM_NOTE.format(omitted)
+
+    pos = 0
+    for out in streams:
+        text = out["text"]
+        keep_head = min(max(head_end - pos, 0), len(text))
+        keep_tail = min(max(tail_start - pos, 0), len(text))
+        if note and keep_tail < len(text):
+            out["text"] = text[:keep_head] + note + text[keep_tail:]
+            note = None
+        else:
+            out["text"] = text[:keep_head] + text[keep_tail:]
+        pos += len(text)
+    return omitted
+
+
+def test_truncate_streams():
+
+    def stream(text, name="stdout"):
+        return nbformat.v4.new_output("stream", name=name, text=text)
+
+    image = nbformat.v4.new_output("display_data", {"image/png": "..."})
+    outputs = [stream("a" * 10), image, stream("b" * 10), stream("c" * 10, "stderr")]
+    assert truncate_streams(outputs, 30) == 0
+    assert truncate_streams(outputs, 10) == 20
+    assert outputs[0]["text"] == "aaaaa"
+    assert outputs[1] is image
+    assert outputs[2]["text"] == ""
+    assert outputs[3]["text"] == OMITTED_STREAM_NOTE.format(20) + "ccccc"
+
+    # Later output replaces the tail, and the note counts everything omitted
+    outputs[3]["text"] += "d" * 10
+    assert truncate_streams(outputs, 10, omitted=20) == 30
+    assert outputs[0]["text"] == "aaaaa"
+    assert outputs[3]["text"] == OMITTED_STREAM_NOTE.format(30) + "ddddd"
+
+
+def inject_parameters(nb, parameters):
+    """Insert a cell overriding parameters after the cell tagged "parameters".
+
+    Only names that the parameters cell assigns are overridden. Returns the
+    index of the injected cell, or None if nothing was injected.
+
+    """
+    for index, cell in enumerate(nb.cells):
+        if "parameters" in cell.get("metadata", {}).get("tags", []):
+            break
+    else:
+        return None
+
+    try:
+        declared = {
+            node.id for node in ast.walk(ast.parse(cell["source"]))
+            if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store)
+        }
+    except SyntaxError:
+        declared = set(parameters)
+
+    lines = [
+        f"{name} = {value!r}" for name, value in parameters.items() if name in declared
+    ]
+    if not lines:
+        return None
+
+    source = "# Parameters\n" + "\n".join(lines)
+    metadata = {"tags": ["injected-parameters"]}
+    nb.cells.insert(index + 1, nbformat.v4.new_code_cell(source, metadata=metadata))
+    return index + 1
+
+
+def test_inject_parameters():
+
+    nb = nbformat.v4.new_notebook(cells=[
+        nbformat.v4.new_code_cell("import numpy as np"),
+        nbformat.v4.new_code_cell(
+            "n_epochs = 100\nsubset = 1.", metadata={"tags": ["parameters"]}
+        ),
+        nbformat.v4.new_code_cell("train(n_epochs)"),
+    ])
+    assert inject_parameters(nb, {"n_epochs": 1, "batch_size": 8}) == 2
+    assert nb.cells[2].source == "# Parameters\nn_epochs = 1"
+    assert nb.cells[3].source == "train(n_epochs)"
+
+    del nb.cells[1].metadata["tags"]
+    assert inject_parameters(nb, {"n_epochs": 1}) is None
+
+
+def parse_parameter(override):
+    """Parse a NAME=VALUE command-line override, with a YAML-typed value."""
+    name, sep, value = override.partition("=")
+    if not sep or not name.isidentifier():
+        raise argparse.ArgumentTypeError(f"expected NAME=VALUE, got {override!r}")
+    return name, yaml.safe_load(value)
+
+
+def kernel_pid(km):
+    """Return the process ID of a running kernel, if known."""
+    return getattr(getattr(km, "provisioner", None), "pid", None)
+
+
+def kernel_peak_rss(km):
+    """Return the peak resident memory of the kernel process in MB, if known.
+
+    This is read from /proc, so it is only available on Linux.
+
+    """
+    pid = kernel_pid(km)
+    if pid is None:
+        return None
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        return None
+
+
+def process_tree_usage(pid):
+    """Return the CPU seconds and resident MB of a process and its descendants.
+
+    CPU time includes descendants that have exited. This is read from /proc,
+    so it returns (None, None) other than on Linux.
+
+    """
+    if pid is None:
+        return None, None
+    ticks = pages = 0
+    pids = [pid]
+    try:
+        while pids:
+            pid = pids.pop()
+            with open(f"/proc/{pid}/stat") as f:
+                # Skip past the command name, which may contain spaces
+                fields = f.read().rsplit(")", 1)[1].split()
+            ticks += sum(int(field) for field in fields[11:15])  # [cs]{u,s}time
+            pages += int(fields[21])
+            for task in os.listdir(f"/proc/{pid}/task"):
+                with open(f"/proc/{pid}/task/{task}/children") as f:
+                    pids.extend(int(child) for child in f.read().split())
+    except (OSError, ValueError):
+        # Processes can exit while we walk the tree
+        if not ticks:
+            return None, None
+    cpu = round(ticks / os.sysconf("SC_CLK_TCK"), 2)
+    rss = round(pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20, 1)
+    return cpu, rss
+
+
+class ForkServerKernelManager(AsyncKernelManager):
+    """Kernel manager that forks kernels from a server with a preloaded prelude.
+
+    The fork server (see configure_kernel_fork_server) imports ipykernel and the
+    prelude modules once, so each kernel starts without paying that cost.
+    Kernels run with the Python environment of this script, not the kernelspec.
+    This overrides jupyter_client internals, so main only uses it with the
+    versions in FORK_SERVER_JUPYTER_CLIENT_MAJOR.
+
+    """
+    async def _async_launch_kernel(self, kernel_cmd, **kw):
+        # Reuse the kernel arguments (connection file, history, etc.)
+        kernel_args = kernel_cmd[kernel_cmd.index("-f"):]
+        process = ForkedKernelProcess(kernel_args, kw.get("env"), kw.get("cwd"))
+
+        # The provisioner owns the kernel process and signals/kills it directly
+        self.provisioner.process = process
+        self.provisioner.pid = process.pid
+        self.provisioner.pgid = None
+        self._reconcile_connection_info(self.provisioner.connection_info)
+
+
+class ForkedKernelProcess:
+    """Minimal Popen-like interface to a kernel forked from the fork server."""
+
+    def __init__(self, kernel_args, env, cwd):
+        ctx = multiprocessing.get_context("forkserver")
+        self._process = ctx.Process(
+            target=run_forked_kernel, args=(kernel_args, env, cwd),
+        )
+        self._process.start()
+        self.pid = self._process.pid
+        self.stdin = self.stdout = self.stderr = None
+
+    def poll(self):
+        return None if self._process.is_alive() else self._process.exitcode
+
+    def wait(self, timeout=None):
+        self._process.join(timeout)
+        return self._process.exitcode
+
+    def send_signal(self, signum):
+        os.kill(self.pid, signum)
+
+    def kill(self):
+        self._process.kill()
+
+    def terminate(self):
+        self._process.terminate()
+
+
+def run_forked_kernel(kernel_args, env, cwd):
+    """Run an IPython kernel in a process forked from the fork server."""
+    if env is not None:
+        os.environ.clear()
+        os.environ.update(env)
+    if cwd is not None:
+        os.chdir(cwd)
+
+    # Forked kernels skip interpreter startup, which reads PYTHONPATH
+    python_path = os.environ.get("PYTHONPATH", "").split(os.pathsep)
+    sys.path[:0] = [path for path in python_path if path and path not in sys.path]
+
+    # Prelude modules sized their thread pools at import, before --pin-cpus
+    # set the thread pool variables for this kernel
+    if "OMP_NUM_THREADS" in os.environ:
+        resize_thread_pools(int(os.environ["OMP_NUM_THREADS"]))
+
+    # matplotlib reads MPLBACKEND at import, before ipykernel can set it
+    if "matplotlib" in sys.modules:
+        backend = os.environ.get(
+            "MPLBACKEND", "module://matplotlib_inline.backend_inline"
+        )
+        sys.modules["matplotlib"].rcParams["backend"] = backend
+
+    # Exit with the fork server, as a kernel would with its launcher
+    parent_handle = f"--IPKernelApp.parent_handle={os.getppid()}"
+
+    from ipykernel.kernelapp import IPKernelApp
+    IPKernelApp.launch_instance(argv=kernel_args + [parent_handle])
+
+
+def resize_thread_pools(n_threads):
+    """Resize the BLAS/OpenMP (and torch) thread pools of imported modules."""
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        pass
+    else:
+        threadpool_limits(n_threads)
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(n_threads)
+
+
+def configure_kernel_fork_server(prelude):
+    """Set the modules that the kernel fork server imports before forking.
+
+    The server is started by the first kernel launched in each process, so
+    with --jobs the prelude is imported once per worker.
+
+    """
+    ctx = multiprocessing.get_context("forkserver")
+    ctx.set_forkserver_preload(["__main__", "ipykernel.kernelapp", *prelude])
+
+
 def execute_notebook(executor, nb, raise_fast):
     """Execute the notebook, returning errors to be handled."""
     try:
@@ -217,6 +1280,255 @@ def execute_notebook(executor, nb, raise_fast):
             return error
 
 
+def find_undefined_names(nb, allow_error_names=(), skips_cell=None):
+    """Resolve names across the executed code cells in order with pyflakes.
+
+    Returns a NameError-style message for each name that is never defined.
+    Cells for which skips_cell returns True are left out. Cells that are allowed
+    to fail (exercise stubs raising an allowed error, or cells tagged
+    "raises-exception") are exempt. Returns an empty list if the code does not
+    parse, leaving the error for the kernel to report.
+
+    """
+    cells = [
+        (index, cell) for index, cell in enumerate(nb.get("cells", []))
+        if cell["cell_type"] == "code"
+        and not (skips_cell is not None and skips_cell(cell))
+    ]
+
+    script, cell_lengths = cells_to_script([
+        {**cell, "source": bind_magic_names(cell["source"])} for _, cell in cells
+    ])
+    try:
+        tree = ast.parse(script)
+    except SyntaxError:
+        return []
+    checker = Checker(tree, builtins=IPYTHON_BUILTINS)
+
+    line_map = remap_line_numbers(cell_lengths)
+    allow_error_pat = re.compile(
+        r"\braise\s+(" + "|".join(map(re.escape, allow_error_names)) + r")\b"
+    )
+    undefined = []
+    for message in sorted(checker.messages, key=lambda m: m.lineno):
+        if not isinstance(message, UndefinedName):
+            continue
+        cell_number, line = line_map[message.lineno]
+        index, cell = cells[cell_number - 1]
+        if "raises-exception" in cell.get("metadata", {}).get("tags", []):
+            continue
+        if allow_error_names and allow_error_pat.search(cell["source"]):
+            continue
+        name, = message.message_args
+        undefined.append(
+            f"NameError: name '{name}' is not defined (cell {index}, line {line})"
+        )
+    return undefined
+
+
+def bind_magic_names(source):
+    """Replace IPython magics that bind names with plain assignments.
+
+    The line count is unchanged, so line numbers still refer to the cell.
+
+    """
+    source = CAPTURE_MAGIC_PATTERN.sub(r"\1 = None", source)
+    return MAGIC_ASSIGNMENT_PATTERN.sub(r"\1 = None", source)
+
+
+def test_find_undefined_names():
+
+    nb = nbformat.v4.new_notebook(cells=[
+        nbformat.v4.new_code_cell("%%capture --no-stderr cap\nprint(1)"),
+        nbformat.v4.new_code_cell("%%capture\nprint(2)"),
+        nbformat.v4.new_code_cell("files = !ls\nt = %timeit -o sum([])"),
+        nbformat.v4.new_code_cell("print(cap.stdout, files, t, undefined)"),
+    ])
+    assert find_undefined_names(nb) == [
+        "NameError: name 'undefined' is not defined (cell 3, line 1)"
+    ]
+
+
+def find_download_urls(nb, skips_cell=None):
+    """Return the literal http(s) URLs in the code cells that will execute."""
+    urls = []
+    for cell in nb.get("cells", []):
+        if cell["cell_type"] != "code" or (skips_cell is not None and skips_cell(cell)):
+            continue
+        for m in DOWNLOAD_URL_PATTERN.finditer(cell["source"]):
+            # Skip URLs built by formatting, which we cannot resolve statically
+            if not cell["source"].startswith("{", m.end()):
+                urls.append(m.group(0).rstrip(".,;:"))
+    return list(dict.fromkeys(urls))
+
+
+def test_find_download_urls():
+
+    nb = nbformat.v4.new_notebook(cells=[
+        nbformat.v4.new_markdown_cell("See https://neuromatch.io."),
+        nbformat.v4.new_code_cell(
+            'url = "https://osf.io/ab12c/download"\n'
+            'fname = pooch.retrieve(f"https://osf.io/{osf_id}/download")\n'
+            "r = requests.get('https://osf.io/ab12c/download')"
+        ),
+    ])
+    assert find_download_urls(nb) == ["https://osf.io/ab12c/download"]
+
+
+def prefetch_downloads(nb, cache_dir, skips_cell=None):
+    """Download the notebook's URLs into a content-addressed cache.
+
+    The contents are stored under objects/ by SHA-256, with a file under urls/
+    (named by the SHA-1 of the URL) that holds the digest. URLs that are already
+    cached or that fail to download are skipped; the kernel can still fetch them.
+
+    """
+    def fetch(url):
+        url_key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        url_file = os.path.join(cache_dir, "urls", url_key)
+        if os.path.exists(url_file):
+            return
+
+        # Stream to a temporary file, as datasets may not fit in memory
+        digest = hashlib.sha256()
+        fd, tmp_fname = tempfile.mkstemp(dir=os.path.join(cache_dir, "objects"))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                with urllib.request.urlopen(url, timeout=120) as response:
+                    for chunk in iter(lambda: response.read(DOWNLOAD_CHUNK_SIZE), b""):
+                        digest.update(chunk)
+                        f.write(chunk)
+        except (OSError, ValueError) as error:
+            os.remove(tmp_fname)
+            print(f"Could not prefetch {url}: {error}", flush=True)
+            return
+        os.replace(tmp_fname, os.path.join(cache_dir, "objects", digest.hexdigest()))
+        write_atomic(url_file, digest.hexdigest().encode("ascii"))
+
+    os.makedirs(os.path.join(cache_dir, "urls"), exist_ok=True)
+    os.makedirs(os.path.join(cache_dir, "objects"), exist_ok=True)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(fetch, find_download_urls(nb, skips_cell)))
+
+
+def download_cache_env(cache_dir):
+    """Return kernel environment variables that activate the download cache."""
+    return {
+        "NMA_DOWNLOAD_CACHE": os.path.abspath(cache_dir),
+        "PYTHONPATH": kernel_python_path(),
+    }
+
+
+def wheelhouse_env(wheelhouse):
+    """Return kernel environment variables that make pip install offline."""
+    return {
+        "PIP_NO_INDEX": "1",
+        "PIP_FIND_LINKS": os.path.abspath(wheelhouse),
+        "PYTHONPATH": kernel_python_path(),
+    }
+
+
+def kernel_python_path():
+    """Return a PYTHONPATH with the kernel extensions (see kernel_site/) first."""
+    return os.pathsep.join([KERNEL_SITE_DIR, *filter(None, [os.environ.get("PYTHONPATH")])])
+
+
+def write_atomic(fname, content):
+    """Write bytes to a file so that concurrent readers never see a partial file."""
+    fd, tmp_fname = tempfile.mkstemp(dir=os.path.dirname(fname) or ".")
+    with os.fdopen(fd, "wb") as f:
+        f.write(content)
+    os.replace(tmp_fname, fname)
+
+
+def execution_cache_key(nb, kernel_name, dep_files, parameters=None, options=None):
+    """Hash the code cells (sources and tags), kernel name and dependency files.
+
+    Parameters and executor options that change the outputs are included, so
+    that, e.g., a run with truncated streams is not reused for a full run.
+
+    """
+    key = hashlib.sha1(kernel_name.encode("utf-8"))
+    if parameters:
+        key.update(json.dumps(parameters, sort_keys=True, default=repr).encode("utf-8"))
+    if options:
+        key.update(json.dumps(options, sort_keys=True).encode("utf-8"))
+    update_dep_files_key(key, dep_files)
+    update_code_cells_key(key, nb.get("cells", []))
+    return key.hexdigest()
+
+
+def update_dep_files_key(key, dep_files):
+    """Add the contents of dependency files (where they exist) to a hash."""
+    for fname in dep_files:
+        if os.path.isfile(fname):
+            with open(fname, "rb") as f:
+                key.update(f.read())
+
+
+def update_code_cells_key(key, cells):
+    """Add the source and tags (e.g. raises-exception) of code cells to a hash."""
+    for cell in cells:
+        if cell["cell_type"] == "code":
+            tags = cell.get("metadata", {}).get("tags", [])
+            key.update(cell["source"].encode("utf-8") + b"\0")
+            key.update(json.dumps(tags).encode("utf-8") + b"\0")
+
+
+def load_cached_outputs(nb, cache_dir, cache_key):
+    """Fill code cell outputs from the execution cache, returning success."""
+    cache_file = os.path.join(cache_dir, f"{cache_key}.json")
+    if not os.path.isfile(cache_file):
+        return False
+    with open(cache_file) as f:
+        cached = nbformat.from_dict(json.load(f))
+
+    code_cells = [cell for cell in nb.get("cells", []) if cell["cell_type"] == "code"]
+    if len(code_cells) != len(cached.cells):
+        return False
+    for cell, cached_cell in zip(code_cells, cached.cells):
+        cell["outputs"] = cached_cell["outputs"]
+        cell["execution_count"] = cached_cell["execution_count"]
+    nb.metadata.update(cached.metadata)
+    return True
+
+
+def store_cached_outputs(nb, cache_dir, cache_key):
+    """Write the code cell outputs of an executed notebook to the cache."""
+    cached = {
+        "metadata": {"language_info": nb.metadata.get("language_info", {})},
+        "cells": [
+            {"outputs": cell["outputs"], "execution_count": cell["execution_count"]}
+            for cell in nb.get("cells", []) if cell["cell_type"] == "code"
+        ],
+    }
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_file = os.path.join(cache_dir, f"{cache_key}.json")
+
+    # Write atomically, as other workers may be reading the cache
+    write_atomic(cache_file, json.dumps(cached).encode("utf-8"))
+
+
+def read_notebook_for_checks(nb_path):
+    """Read only what the static QC checks need from a notebook file.
+
+    This skips nbformat's schema validation and NotebookNode conversion, and
+    drops output payloads (e.g. base64 images) other than error tracebacks.
+
+    """
+    with open(nb_path, "rb") as f:
+        nb = json.load(f)
+
+    for cell in nb.get("cells", []):
+        if isinstance(cell["source"], list):
+            cell["source"] = "".join(cell["source"])
+        cell["outputs"] = [
+            output for output in cell.get("outputs", [])
+            if output["output_type"] == "error"
+        ]
+    return nb
+
+
 def check_execution(executor, nb, raise_fast):
     """Check that all code cells with source have been executed without error."""
     error = None
@@ -246,7 +1558,7 @@ def check_execution(executor, nb, raise_fast):
 
 def extract_solutions(nb, nb_dir, nb_name):
     """Convert solution cells to markdown; embed images from Python output."""
-    nb = deepcopy(nb)
+    nb = copy_notebook(nb)
     _, tutorial_dir = os.path.split(nb_dir)
 
     static_images = {}
@@ -272,7 +1584,7 @@ def extract_solutions(nb, nb_dir, nb_name):
                     image_data = a2b_base64(output["data"]["image/png"])
                 except KeyError:
                     continue
-                cell_images[fname] = Image.open(BytesIO(image_data))
+                cell_images[fname] = image_data
             static_images.update(cell_images)
 
             # Clean up the cell source and assign a filename
@@ -288,14 +1600,16 @@ def extract_solutions(nb, nb_dir, nb_name):
 
             if cell_images:
                 new_source += "*Example output:*\n\n"
-                for f, img in cell_images.items():
+                for f, image_data in cell_images.items():
 
                     url = f"{GITHUB_RAW_URL}/tutorials/{tutorial_dir}/{f}"
 
                     # Handle matplotlib retina mode
-                    dpi_w, dpi_h = img.info["dpi"]
-                    w = img.width // (dpi_w // 72)
-                    h = img.height // (dpi_h // 72)
+                    (w, h), dpi = png_size_and_dpi(image_data)
+                    if dpi is not None:
+                        dpi_w, dpi_h = dpi
+                        w = w // (dpi_w // 72 or 1)
+                        h = h // (dpi_h // 72 or 1)
 
                     tag_args = " ".join([
                         "alt='Solution hint'",
@@ -306,6 +1620,7 @@ def extract_solutions(nb, nb_dir, nb_name):
                     ])
                     new_source += f"<img {tag_args}>\n\n"
 
+            cell = nb_cells[i] = copy_cell(cell)
             cell["source"] = new_source
             cell["cell_type"] = "markdown"
             cell["metadata"]["colab_type"] = "text"
@@ -319,9 +1634,54 @@ def extract_solutions(nb, nb_dir, nb_name):
     return nb, static_images, solution_snippets
 
 
+def png_size_and_dpi(data):
+    """Read the size and DPI of a PNG from its header, without decoding it.
+
+    Returns ((width, height), (dpi_w, dpi_h)), where the DPI is None if the
+    image has no pHYs chunk or the chunk does not specify a physical unit.
+
+    """
+    if data[:8] != b"\x89PNG\r\n\x1a\n":
+        raise ValueError("Solution image is not a PNG")
+
+    # The IHDR chunk always comes first
+    size = struct.unpack(">II", data[16:24])
+
+    # Walk the chunks until the pixel data; pHYs must appear before it
+    pos = 8
+    while pos + 8 <= len(data):
+        length, kind = struct.unpack(">I4s", data[pos:pos + 8])
+        if kind == b"IDAT":
+            break
+        if kind == b"pHYs":
+            ppu_x, ppu_y, unit = struct.unpack(">IIB", data[pos + 8:pos + 17])
+            if unit == 1:  # pixels per meter
+                return size, (ppu_x * 0.0254, ppu_y * 0.0254)
+            break
+        pos += length + 12  # length, type, data and CRC
+
+    return size, None
+
+
+def test_png_size_and_dpi():
+
+    signature = b"\x89PNG\r\n\x1a\n"
+    ihdr = struct.pack(">I4sIIBBBBBI", 13, b"IHDR", 400, 300, 8, 6, 0, 0, 0, 0)
+    phys = struct.pack(">I4sIIBI", 9, b"pHYs", 5669, 5669, 1, 0)
+    idat = struct.pack(">I4sI", 0, b"IDAT", 0)
+
+    size, dpi = png_size_and_dpi(signature + ihdr + phys + idat)
+    assert size == (400, 300)
+    assert round(dpi[0]) == round(dpi[1]) == 144
+
+    size, dpi = png_size_and_dpi(signature + ihdr + idat)
+    assert size == (400, 300)
+    assert dpi is None
+
+
 def instructor_version(nb, nb_dir, nb_name):
     """Convert notebook to instructor notebook."""
-    nb = deepcopy(nb)
+    nb = copy_notebook(nb)
     _, tutorial_dir = os.path.split(nb_dir)
 
     nb_cells = nb.get("cells", [])
@@ -332,6 +1692,7 @@ def instructor_version(nb, nb_dir, nb_name):
                 cell_id = i-2
             else:
                 cell_id = i-1
+            nb_cells[cell_id] = copy_cell(nb_cells[cell_id])
             nb_cells[cell_id]["cell_type"] = "markdown"
             nb_cells[cell_id]["metadata"]["colab_type"] = "text"
             if "outputID" in nb_cells[cell_id]["metadata"]:
@@ -349,7 +1710,7 @@ def instructor_version(nb, nb_dir, nb_name):
 def clean_notebook(nb, clear_outputs=True):
     """Remove cell outputs and most unimportant metadata."""
     # Always operate on a copy of the input notebook
-    nb = deepcopy(nb)
+    nb = copy_notebook(nb)
 
     # Remove some noisy metadata
     nb.metadata.pop("widgets", None)
@@ -359,13 +1720,15 @@ def clean_notebook(nb, clear_outputs=True):
         "display_name": "Python 3", "language": "python", "name": "python3"
     }
 
-    # Iterate through the cells and clean up each one
+    # Iterate through the cells and clean up a copy of each one
+    cells = []
     for cell in nb.get("cells", []):
 
         # Remove blank cells
         if not cell["source"]:
-            nb.cells.remove(cell)
             continue
+        cell = copy_cell(cell)
+        cells.append(cell)
 
         # Reset cell-level Jupyter metadata
         for key in ["prompt_number", "execution_count"]:
@@ -392,9 +1755,61 @@ def clean_notebook(nb, clear_outputs=True):
             if "@title" in first_line or "@markdown" in first_line:
                 cell["metadata"]["cellView"] = "form"
 
+    nb["cells"] = cells
     return nb
 
 
+def copy_notebook(nb):
+    """Copy the notebook structure, sharing the cells with the original.
+
+    Transformations must replace a cell with copy_cell(cell) before changing it.
+
+    """
+    nb_copy = copy(nb)
+    nb_copy["metadata"] = deepcopy(nb["metadata"])
+    if "cells" in nb:
+        nb_copy["cells"] = list(nb["cells"])
+    return nb_copy
+
+
+def copy_cell(cell):
+    """Copy a cell for modification, sharing its (possibly large) outputs.
+
+    The outputs list is shared, so it must be replaced rather than mutated.
+
+    """
+    cell_copy = copy(cell)
+    if "metadata" in cell:
+        cell_copy["metadata"] = deepcopy(cell["metadata"])
+    return cell_copy
+
+
+def test_clean_notebook():
+
+    image = {"output_type": "display_data", "data": {"image/png": "..."}}
+    nb = nbformat.from_dict({
+        "metadata": {"widgets": {}},
+        "cells": [
+            {"cell_type": "code", "source": "", "metadata": {}, "outputs": []},
+            {"cell_type": "code", "source": "", "metadata": {}, "outputs": []},
+            {"cell_type": "code", "source": "plot()", "metadata": {"scrolled": True},
+             "execution_count": 1, "outputs": [image]},
+        ]
+    })
+    nb_clean = clean_notebook(nb, clear_outputs=False)
+
+    # Consecutive blank cells are all removed
+    assert len(nb_clean.cells) == 1
+    assert nb_clean.cells[0].execution_count is None
+    assert nb_clean.cells[0].outputs[0] is nb.cells[2].outputs[0]
+
+    # The input notebook is left untouched
+    assert len(nb.cells) == 3
+    assert nb.cells[2].execution_count == 1
+    assert nb.cells[2].metadata == {"scrolled": True}
+    assert "widgets" in nb.metadata
+
+
 def add_colab_metadata(nb, nb_name):
     """Ensure that notebook has Colab metadata and enforce some settings."""
     if "colab" not in nb["metadata"]:
@@ -577,6 +1992,99 @@ def sequentially_executed(nb):
     return exec_counts == sequential_counts
 
 
+def write_if_changed(fname, content):
+    """Write str or bytes content to fname, unless the file already matches it.
+
+    Leaving unchanged files alone avoids mtime churn that invalidates
+    downstream caches (e.g. the Jupyter Book build).
+
+    """
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+
+    if os.path.isfile(fname):
+        with open(fname, "rb") as f:
+            on_disk = hashlib.sha1(f.read()).digest()
+        if on_disk == hashlib.sha1(content).digest():
+            return False
+
+    with open(fname, "wb") as f:
+        f.write(content)
+    return True
+
+
+def write_artifacts(artifacts, counts):
+    """Write a dict of {fname: content} across threads, counting skipped files."""
+    with ThreadPoolExecutor() as pool:
+        changed = list(pool.map(write_if_changed, artifacts, artifacts.values()))
+    counts["written"] += sum(changed)
+    counts["unchanged"] += len(changed) - sum(changed)
+
+
+def serialize_notebook(nb):
+    """Return the notebook as text, exactly as nbformat.write would write it."""
+    content = nbformat.writes(nb)
+    if not content.endswith("\n"):
+        content += "\n"
+    return content
+
+
+def load_timings(fname):
+    """Load the {nb_path: seconds} execution timings file, if it exists."""
+    if fname is None or not os.path.isfile(fname):
+        return {}
+    with open(fname) as f:
+        return json.load(f)
+
+
+def parse_shard(shard):
+    """Parse an i/n (1-based) shard command-line argument."""
+    try:
+        i, n = map(int, shard.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/n, got {shard!r}")
+    if not 1 <= i <= n:
+        raise argparse.ArgumentTypeError(f"shard index must be between 1 and {n}, got {i}")
+    return i, n
+
+
+def shard_notebooks(nb_paths, shard, timings):
+    """Return the notebooks assigned to shard (i, n) (1-based), in input order.
+
+    Notebooks are assigned longest-first to the shard with the least total
+    runtime so far, using historical timings (the median for new notebooks).
+    Every shard computes the same assignment, so together they cover all paths.
+
+    """
+    i, n = shard
+    known = sorted(timings[path] for path in nb_paths if path in timings)
+    default = known[len(known) // 2] if known else 1
+    runtime = {path: timings.get(path, default) for path in nb_paths}
+
+    loads = [0] * n
+    assigned = set()
+    for path in sorted(nb_paths, key=lambda path: (-runtime[path], path)):
+        k = min(range(n), key=lambda k: loads[k])
+        loads[k] += runtime[path]
+        if k == i - 1:
+            assigned.add(path)
+
+    return [path for path in nb_paths if path in assigned]
+
+
+def test_shard_notebooks():
+
+    timings = {"a.ipynb": 10, "b.ipynb": 6, "c.ipynb": 5, "d.ipynb": 4}
+    nb_paths = ["a.ipynb", "b.ipynb", "c.ipynb", "d.ipynb", "new.ipynb"]
+
+    shards = [shard_notebooks(nb_paths, (i, 2), timings) for i in [1, 2]]
+    assert shards[0] == ["a.ipynb", "c.ipynb"]
+    assert shards[1] == ["b.ipynb", "d.ipynb", "new.ipynb"]
+
+    shards = [shard_notebooks(nb_paths, (i, 3), {}) for i in [1, 2, 3]]
+    assert sorted(sum(shards, [])) == sorted(nb_paths)
+
+
 def make_sub_dir(nb_dir, name):
     """Create nb_dir/name if it does not exist."""
     sub_dir = os.path.join(nb_dir, name)
@@ -585,12 +2093,46 @@ def make_sub_dir(nb_dir, name):
     return sub_dir
 
 
-def exit(errors):
+def write_profile(profile, fname):
+    """Write the per-cell execution profile to a .csv or .json file."""
+    fields = ["notebook", "cell", "wall_time", "cpu_time", "peak_rss_mb", "first_line"]
+    with open(fname, "w", newline="") as f:
+        if fname.endswith(".csv"):
+            writer = csv.DictWriter(f, fields)
+            writer.writeheader()
+            writer.writerows(profile)
+        else:
+            json.dump(profile, f, indent=1)
+
+
+def exit(errors, profile=(), n_slowest=10):
     """Exit with message and status dependent on contents of errors dict."""
     for failed_file, error in errors.items():
         print(f"{failed_file} failed quality control.", file=sys.stderr)
         print(error, file=sys.stderr)
 
+    if profile and n_slowest:
+        print("Slowest cells:")
+        slowest = sorted(profile, key=lambda row: row["wall_time"], reverse=True)
+        for row in slowest[:n_slowest]:
+            rss = row["peak_rss_mb"]
+            rss = "" if rss is None else f" ({rss:.0f} MB peak)"
+            print(
+                f"{row['wall_time']:9.1f} s  {row['notebook']} cell {row['cell']}"
+                f"{rss}: {row['first_line']}"
+            )
+
+    if profile:
+        print("Peak kernel usage by notebook:")
+        usage = {}
+        for row in profile:
+            cpu, rss = usage.get(row["notebook"], (0, 0))
+            usage[row["notebook"]] = (
+                cpu + (row["cpu_time"] or 0), max(rss, row["peak_rss_mb"] or 0)
+            )
+        for notebook, (cpu, rss) in usage.items():
+            print(f"{rss:9.0f} MB {cpu:9.1f} s CPU  {notebook}")
+
     status = bool(errors)
     report = "Failure" if status else "Success"
     print("=" * 30, report, "=" * 30)
@@ -636,6 +2178,168 @@ def parse_args(arglist):
         dest="raise_fast",
         help="Raise errors immediately rather than collecting and reporting."
     )
+    parser.add_argument(
+        "--jobs", "-j",
+        type=int,
+        default=1,
+        help="Number of notebooks to load, check and execute in parallel."
+    )
+    parser.add_argument(
+        "--cache-dir",
+        dest="cache_dir",
+        help="Reuse executed outputs stored here when the code is unchanged."
+    )
+    parser.add_argument(
+        "--cache-dep",
+        action="append",
+        dest="cache_deps",
+        help="File whose contents invalidate the execution cache and kernel "
+             "checkpoints (can be repeated; default: requirements.txt)."
+    )
+    parser.add_argument(
+        "--profile",
+        help="Write per-cell execution times and kernel memory to this .json/.csv file."
+    )
+    parser.add_argument(
+        "--n-slowest",
+        type=int,
+        default=10,
+        dest="n_slowest",
+        help="Number of slowest cells to summarize in the final report."
+    )
+    parser.add_argument(
+        "--kernel-prelude",
+        dest="kernel_prelude",
+        help="Comma-separated modules to import once in a kernel fork server "
+             "(e.g. numpy,scipy,matplotlib.pyplot); kernels are forked from it."
+    )
+    parser.add_argument(
+        "--fast-render",
+        action="store_true",
+        dest="fast_render",
+        help="Skip rendering figures in tutorial cells whose outputs are "
+             "discarded; solution cells still render their images."
+    )
+    parser.add_argument(
+        "-P", "--parameter",
+        action="append",
+        dest="parameters",
+        type=parse_parameter,
+        metavar="NAME=VALUE",
+        help="Override a name assigned in the cell tagged 'parameters' when "
+             "executing (repeatable); the value is parsed as YAML."
+    )
+    parser.add_argument(
+        "--parameters-file",
+        dest="parameters_file",
+        help="YAML file mapping parameter names to override values; "
+             "-P overrides take precedence."
+    )
+    parser.add_argument(
+        "--skip-widgets",
+        action="store_true",
+        dest="skip_widgets",
+        help="Do not execute video, slide and feedback @title cells; "
+             "their existing outputs are kept."
+    )
+    parser.add_argument(
+        "--skip-title",
+        action="append",
+        dest="skip_titles",
+        metavar="PATTERN",
+        help="Do not execute cells whose @title matches this regex (repeatable)."
+    )
+    parser.add_argument(
+        "--skip-tag",
+        action="append",
+        dest="skip_tags",
+        metavar="TAG",
+        help="Do not execute cells with this tag (repeatable)."
+    )
+    parser.add_argument(
+        "--preflight",
+        action="store_true",
+        help="Before executing, reject notebooks that use names that no earlier "
+             "cell defines (checked statically with pyflakes)."
+    )
+    parser.add_argument(
+        "--download-cache",
+        dest="download_cache",
+        help="Prefetch the URLs in executed notebooks into this directory, "
+             "and serve kernel downloads (via urllib or requests) from it."
+    )
+    parser.add_argument(
+        "--wheelhouse",
+        help="Make pip in executing kernels install offline from wheels in this "
+             "directory (e.g. built with 'pip wheel -r requirements.txt -w DIR'), "
+             "and skip '%%pip install' and '!pip install' commands that are "
+             "already satisfied."
+    )
+    parser.add_argument(
+        "--coalesce-streams",
+        action="store_true",
+        dest="coalesce_streams",
+        help="Merge consecutive stream outputs while executing, applying "
+             "carriage returns (e.g. from progress bars) as they arrive."
+    )
+    parser.add_argument(
+        "--max-stream-chars",
+        dest="max_stream_chars",
+        type=int,
+        metavar="N",
+        help="Keep at most N characters of stream output per cell, from its "
+             "start and end; other outputs are always kept."
+    )
+    parser.add_argument(
+        "--hang-timeout",
+        dest="hang_timeout",
+        type=float,
+        metavar="SECONDS",
+        help="Kill the kernel and fail the notebook (reporting the kernel's "
+             "Python stacks) if a cell produces no output and uses no CPU for "
+             "this long."
+    )
+    parser.add_argument(
+        "--pin-cpus",
+        action="store_true",
+        dest="pin_cpus",
+        help="Pin each kernel to an equal share of the CPUs (one per --jobs "
+             "worker) and size BLAS/OpenMP thread pools to match. A notebook "
+             "can ask for more with metadata like {\"nmaci\": {\"threads\": 8}}."
+    )
+    parser.add_argument(
+        "--max-memory",
+        dest="max_memory",
+        type=float,
+        metavar="MB",
+        help="Fail a notebook (killing its kernel) if the kernel and its "
+             "subprocesses use more resident memory than this."
+    )
+    parser.add_argument(
+        "--max-cpu-time",
+        dest="max_cpu_time",
+        type=float,
+        metavar="SECONDS",
+        help="Fail a notebook (killing its kernel) if the kernel and its "
+             "subprocesses use more CPU time than this."
+    )
+    parser.add_argument(
+        "--checkpoint-dir",
+        dest="checkpoint_dir",
+        help="Save kernel state (with dill) at section headers here, and resume "
+             "execution from the last checkpoint whose earlier code is unchanged."
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        metavar="I/N",
+        help="Only process shard i/n of the notebooks, balanced by runtime."
+    )
+    parser.add_argument(
+        "--timings",
+        help="JSON file of per-notebook execution times, "
+             "used for --shard and updated after executing."
+    )
     return parser.parse_args(arglist)
 
 
@@ -1,10 +1,37 @@
 """From a list of files, select process-able notebooks and print."""
 import os
 import sys
+import argparse
+
+from process_notebooks import load_timings, parse_shard, shard_notebooks
+
+
+def parse_args(arglist):
+    """Handle the command-line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Select neuromatch tutorial notebooks to process",
+    )
+    parser.add_argument(
+        "files",
+        nargs="*",
+        help="File name(s) to select from."
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        metavar="I/N",
+        help="Only select shard i/n of the notebooks, balanced by runtime."
+    )
+    parser.add_argument(
+        "--timings",
+        help="JSON file of per-notebook execution times, used for --shard."
+    )
+    return parser.parse_args(arglist)
+
 
 if __name__ == "__main__":
 
-    _, *files = sys.argv
+    args = parse_args(sys.argv[1:])
 
     # Filter paths from the git manifest
     # - Only process .ipynb
@@ -18,5 +45,7 @@ if __name__ == "__main__":
             os.path.isfile(path),
         ])
 
-    nb_paths = [f for f in files if should_process(f)]
+    nb_paths = [f for f in args.files if should_process(f)]
+    if args.shard is not None:
+        nb_paths = shard_notebooks(nb_paths, args.shard, load_timings(args.timings))
     print(" ".join(nb_paths))
@@ -17,11 +17,25 @@ This script will report whether exercises and solutions otherwise match.
 import os
 import re
 import sys
+import json
+import time
+import difflib
+import hashlib
+import tempfile
 import argparse
 from textwrap import dedent
-from fuzzywuzzy import fuzz
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+import xml.etree.ElementTree as ET
+from rapidfuzz import fuzz, process
 import nbformat
 
+# Splits a line into code and the text of a trailing comment
+COMMENT_PATTERN = re.compile(r"^([^#]*)\s*#* {0,1}(.*?)\s*$")
+
+# Change this to invalidate cached results when the matching logic changes
+CACHE_VERSION = 1
+
 
 def main(arglist):
 
@@ -33,49 +47,40 @@ def main(arglist):
         print("Skipping exercise verification")
         sys.exit(0)
 
+    # Verify each notebook, in parallel with --jobs
+    if args.jobs > 1 and len(args.files) > 1:
+        with ProcessPoolExecutor(min(args.jobs, len(args.files))) as pool:
+            results = list(pool.map(
+                timed_verify_notebook,
+                args.files,
+                repeat(args.align),
+                repeat(args.cache_dir),
+            ))
+    else:
+        results = [
+            timed_verify_notebook(nb_fpath, args.align, args.cache_dir)
+            for nb_fpath in args.files
+        ]
+
     # Track overall status
-    failure = False
     unmatched = {}
-
-    for nb_fpath in args.files:
-
+    seconds = {}
+    for nb_fpath, (nb_unmatched, nb_seconds) in zip(args.files, results):
         _, nb_name = os.path.split(nb_fpath)
-        unmatched[nb_name] = []
-
-        # Load the notebook file
-        with open(nb_fpath) as f:
-            nb = nbformat.read(f, nbformat.NO_CONVERT)
-
-        for i, cell in enumerate(nb.get("cells", [])):
-
-            # Detect solution cells based on removal tag
-            if has_solution(cell):
-
-                # Find a corresponding exercise cell
-                # (Assume it is the previous *code* cell)
-                j, stub_cell = 1, None
-                while (i - j):
-                    stub_cell = nb["cells"][i - j]
-                    if stub_cell["cell_type"] == "code":
-                        break
-                    else:
-                        stub_cell = None
-                    j += 1
-                if stub_cell is None:
-                    continue
-
-                # Extract the code and comments from both cells
-                stub_code, stub_comments = logical_lines(stub_cell["source"])
-                solu_code, solu_comments = logical_lines(cell["source"])
-
-                # Identify violations in the exercise cell
-                unmatched_code = unmatched_lines(stub_code, solu_code)
-                unmatched_comments = unmatched_lines(
-                    stub_comments, solu_code + solu_comments
-                )
-                unmatched[nb_name].append((unmatched_code, unmatched_comments))
-                if unmatched_code or unmatched_comments:
-                    failure = True
+        unmatched[nb_name] = nb_unmatched
+        seconds[nb_name] = nb_seconds
+    failure = any(
+        code or comments
+        for nb_unmatched in unmatched.values()
+        for code, comments in nb_unmatched
+    )
+
+    # Write machine-readable reports
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(json_report(unmatched, seconds), f, indent=2)
+    if args.junit is not None:
+        write_junit(args.junit, unmatched, seconds)
 
     # Report the results for this noteobokk
     for nb_name, nb_unmatched in unmatched.items():
@@ -90,23 +95,229 @@ def main(arglist):
     sys.exit(failure)
 
 
+def verify_notebook(nb_fpath, align=False, cache_dir=None):
+    """Return unmatched (code, comments) lines for each exercise in a notebook."""
+    # Load the notebook file
+    with open(nb_fpath) as f:
+        nb = nbformat.read(f, nbformat.NO_CONVERT)
+
+    nb_unmatched = []
+    for stub_cell, cell in exercise_pairs(nb.get("cells", [])):
+
+        # Reuse the results for exercises that have not changed
+        cache_file = None
+        if cache_dir is not None:
+            cache_key = exercise_cache_key(stub_cell["source"], cell["source"], align)
+            cache_file = os.path.join(cache_dir, f"{cache_key}.json")
+            if os.path.isfile(cache_file):
+                with open(cache_file) as f:
+                    cached = json.load(f)
+                nb_unmatched.append(tuple(
+                    [tuple(line) for line in lines] for lines in cached
+                ))
+                continue
+
+        unmatched = verify_exercise(stub_cell["source"], cell["source"], align)
+        nb_unmatched.append(unmatched)
+
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            store_cached_result(cache_file, unmatched)
+
+    return nb_unmatched
+
+
+def store_cached_result(cache_file, unmatched):
+    """Write a result to the cache without other workers seeing a partial file."""
+    fd, tmp_fname = tempfile.mkstemp(dir=os.path.dirname(cache_file))
+    with os.fdopen(fd, "w") as f:
+        json.dump(unmatched, f)
+    os.replace(tmp_fname, cache_file)
+
+
+def timed_verify_notebook(nb_fpath, align=False, cache_dir=None):
+    """Verify a notebook, also returning the time it took in seconds."""
+    start = time.perf_counter()
+    nb_unmatched = verify_notebook(nb_fpath, align, cache_dir)
+    return nb_unmatched, time.perf_counter() - start
+
+
+def verify_exercise(stub_source, solu_source, align=False):
+    """Return unmatched code and comment lines for one exercise/solution pair."""
+    # Extract the code and comments from both cells
+    stub_code, stub_comments = logical_lines(stub_source)
+    solu_code, solu_comments = logical_lines(solu_source)
+
+    # Identify violations in the exercise cell
+    if align:
+        unmatched_code = aligned_unmatched_lines(stub_code, solu_code)
+        unmatched_comments = aligned_unmatched_lines(stub_comments, solu_comments)
+        # Comments may also be commented-out solution code
+        unmatched_comments = unmatched_lines(
+            [stub for _, stub, _ in unmatched_comments],
+            solu_code + solu_comments,
+        )
+    else:
+        unmatched_code = unmatched_lines(stub_code, solu_code)
+        unmatched_comments = unmatched_lines(
+            stub_comments, solu_code + solu_comments
+        )
+    return unmatched_code, unmatched_comments
+
+
+def exercise_cache_key(stub_source, solu_source, align=False):
+    """Hash the exercise and solution sources with the matching mode."""
+    key = hashlib.sha1(f"{CACHE_VERSION} {'align' if align else 'best'}".encode())
+    for source in (stub_source, solu_source):
+        key.update(source.encode("utf-8") + b"\0")
+    return key.hexdigest()
+
+
+def test_verify_notebook_cache(tmp_path):
+
+    cells = [
+        nbformat.v4.new_code_cell("import numpy as np"),
+        nbformat.v4.new_code_cell("x = ...\nz = x + y"),
+        nbformat.v4.new_code_cell("# to_remove solution\nx = np.arange(10)"),
+    ]
+    nb_fpath = tmp_path / "exercise.ipynb"
+    nbformat.write(nbformat.v4.new_notebook(cells=cells), nb_fpath)
+    cache_dir = tmp_path / "cache"
+
+    unmatched = verify_notebook(nb_fpath, cache_dir=cache_dir)
+    assert unmatched == [([(23, "z = x + y", "x = np.arange(10)")], [])]
+    assert len(os.listdir(cache_dir)) == 1
+    assert verify_notebook(nb_fpath, cache_dir=cache_dir) == unmatched
+
+    verify_notebook(nb_fpath, align=True, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 2
+
+
+def exercise_pairs(cells):
+    """Pair each solution cell with its exercise, in one pass over the cells.
+
+    The exercise is assumed to be the previous *code* cell. As before, the
+    first cell of the notebook is never taken to be an exercise.
+
+    """
+    pairs = []
+    stub_cell = None
+    for i, cell in enumerate(cells):
+
+        # Detect solution cells based on removal tag
+        if has_solution(cell) and stub_cell is not None:
+            pairs.append((stub_cell, cell))
+
+        if i and cell["cell_type"] == "code":
+            stub_cell = cell
+
+    return pairs
+
+
+def test_exercise_pairs():
+
+    def cell(cell_type, source):
+        return {"cell_type": cell_type, "source": source}
+
+    setup = cell("code", "import numpy as np")
+    stub = cell("code", "x = ...")
+    solution = cell("code", "# to_remove solution\nx = 1")
+    text = cell("markdown", "# @title Solution")
+    cells = [setup, text, stub, text, solution, solution]
+    pairs = exercise_pairs(cells)
+    assert pairs == [(stub, text), (stub, solution), (solution, solution)]
+
+
 def report(exercise, code, comment, thresh=50):
     """Print information about unmatched code and comments in an exercise."""
+    print("\n".join(format_report(exercise, code, comment, thresh)))
+
+
+def format_report(exercise, code, comment, thresh=50):
+    """Return report lines about unmatched code and comments in an exercise."""
     code_status = "FAIL" if code else "PASS"
     comment_status = "FAIL" if comment else "PASS"
-    print(
+    lines = [
         f"Exercise {exercise} | Code {code_status} | Comments {comment_status}"
-    )
+    ]
 
     for kind, unmatched in zip(["Code", "Comment"], [code, comment]):
         for (score, stub, solu) in unmatched:
             if score < thresh:
-                print(f"  {kind} without close match:")
-                print(f"  * {stub}")
+                lines.append(f"  {kind} without close match:")
+                lines.append(f"  * {stub}")
             else:
-                print(f"  {kind} with close mismatch ({score}%)")
-                print(f"  + {stub}")
-                print(f"  - {solu}")
+                lines.append(f"  {kind} with close mismatch ({score}%)")
+                lines.append(f"  + {stub}")
+                lines.append(f"  - {solu}")
+
+    return lines
+
+
+def json_report(unmatched, seconds):
+    """Structure the results for all notebooks for a JSON report."""
+    def line_scores(lines):
+        return [
+            {"score": score, "stub": stub, "solution": solu}
+            for score, stub, solu in lines
+        ]
+
+    notebooks = []
+    for nb_name, nb_unmatched in unmatched.items():
+        exercises = [
+            {
+                "exercise": exercise,
+                "passed": not (code or comments),
+                "code": line_scores(code),
+                "comments": line_scores(comments),
+            }
+            for exercise, (code, comments) in enumerate(nb_unmatched, 1)
+        ]
+        notebooks.append({
+            "name": nb_name,
+            "seconds": round(seconds[nb_name], 3),
+            "passed": all(exercise["passed"] for exercise in exercises),
+            "exercises": exercises,
+        })
+    return {
+        "passed": all(notebook["passed"] for notebook in notebooks),
+        "notebooks": notebooks,
+    }
+
+
+def test_json_report():
+
+    unmatched = {"nb.ipynb": [([], []), ([(63, "z = x + y", "y = x ** 2")], [])]}
+    report = json_report(unmatched, {"nb.ipynb": 0.1234})
+    notebook, = report["notebooks"]
+    assert not report["passed"]
+    assert notebook["seconds"] == 0.123
+    assert [exercise["passed"] for exercise in notebook["exercises"]] == [True, False]
+    assert notebook["exercises"][1]["code"] == [
+        {"score": 63, "stub": "z = x + y", "solution": "y = x ** 2"}
+    ]
+
+
+def write_junit(fname, unmatched, seconds):
+    """Write a JUnit XML report with a test case for each exercise."""
+    suites = ET.Element("testsuites", name="verify_exercises")
+    for nb_name, nb_unmatched in unmatched.items():
+        suite = ET.SubElement(
+            suites, "testsuite",
+            name=nb_name,
+            tests=str(len(nb_unmatched)),
+            failures=str(sum(bool(code or comm) for code, comm in nb_unmatched)),
+            time=f"{seconds[nb_name]:.3f}",
+        )
+        for exercise, (code, comments) in enumerate(nb_unmatched, 1):
+            case = ET.SubElement(
+                suite, "testcase", classname=nb_name, name=f"Exercise {exercise}"
+            )
+            if code or comments:
+                lines = format_report(exercise, code, comments)
+                failure = ET.SubElement(case, "failure", message=lines[0])
+                failure.text = "\n".join(lines[1:])
+    ET.ElementTree(suites).write(fname, encoding="utf-8", xml_declaration=True)
 
 
 def logical_lines(func_str):
@@ -114,9 +325,6 @@ def logical_lines(func_str):
     # Standardize docstring string format
     func_str = func_str.replace("'''", '"""')
 
-    # Define a regular expression to remove comments
-    pattern = re.compile(r"^([^#]*)\s*#* {0,1}(.*?)\s*$")
-
     code_lines = []
     comment_lines = []
 
@@ -150,7 +358,7 @@ def logical_lines(func_str):
                 reading_block_comment = True
                 continue
 
-        match = pattern.match(line)
+        match = COMMENT_PATTERN.match(line)
         if match:
 
             # Split the line on the first comment hash encountered
@@ -181,31 +389,57 @@ def logical_lines(func_str):
 
 
 def unmatched_lines(stub_lines, solu_lines):
-    """Identify lines in the exercise stub without a match in the solution."""
-    unmatched = []
+    """Identify lines in the exercise stub without a match in the solution.
+
+    Lines with an exact match are skipped; the rest are scored against every
+    solution line in one batch. Scores are rounded to whole percentages (as
+    with fuzzywuzzy), so the report thresholds keep their meaning.
+
+    """
+    solu_set = set(solu_lines)
+
+    # Match whole lines or parts of lines that need completion
+    whole_lines = []
+    line_parts = {}
+    for stub_line in dict.fromkeys(stub_lines):
+        if stub_line in solu_set:
+            continue
+        if "..." in stub_line:
+            line_parts[stub_line] = [part for part in stub_line.split("...") if part]
+        else:
+            whole_lines.append(stub_line)
+
+    line_scores = {}
+    if solu_lines and whole_lines:
+        scores = process.cdist(whole_lines, solu_lines, scorer=fuzz.ratio)
+        line_scores.update(zip(whole_lines, scores.round()))
+    parts = [part for stub_parts in line_parts.values() for part in stub_parts]
+    if solu_lines and parts:
+        scores = process.cdist(parts, solu_lines, scorer=fuzz.partial_ratio).round()
+        start = 0
+        for stub_line, stub_parts in line_parts.items():
+            if stub_parts:
+                # A line matches only as well as its worst-matching part
+                end = start + len(stub_parts)
+                line_scores[stub_line] = scores[start:end].min(axis=0)
+                start = end
 
+    unmatched = []
     for stub_line in stub_lines:
 
+        # Lines that were matched exactly (or are only an ellipsis)
+        if stub_line in solu_set or not line_parts.get(stub_line, True):
+            continue
+
         # When we don't match, we want to track lines that are close
         best_score = 0
         best_line = ""
-
-        for line in solu_lines:
-
-            # Match whole lines or parts of lines that need completion
-            if "..." in stub_line:
-                part_scores = []
-                for part in stub_line.split("..."):
-                    if not part:
-                        continue
-                    part_scores.append(fuzz.partial_ratio(part, line))
-                score = min(part_scores)
-            else:
-                score = fuzz.ratio(stub_line, line)
-
-            if score > best_score:
-                best_score = score
-                best_line = line
+        if solu_lines:
+            scores = line_scores[stub_line]
+            best = int(scores.argmax())
+            if scores[best] > 0:
+                best_score = int(scores[best])
+                best_line = solu_lines[best]
 
         # Track all lines that are not perfect matches
         if best_score < 100:
@@ -214,6 +448,45 @@ def unmatched_lines(stub_lines, solu_lines):
     return unmatched
 
 
+def test_unmatched_lines():
+
+    solu_lines = ["x = np.arange(10)", "y = x ** 2", "ax.plot(x, y)"]
+    stub_lines = ["x = np.arange(10)", "y = ...", "ax.plot(..., ...)", "z = x + y"]
+    unmatched = unmatched_lines(stub_lines, solu_lines)
+    assert unmatched == [(63, "z = x + y", "y = x ** 2")]
+    assert unmatched_lines(["..."], solu_lines) == []
+    assert unmatched_lines(["y = x ** 2"], []) == [(0, "y = x ** 2", "")]
+
+
+def aligned_unmatched_lines(stub_lines, solu_lines):
+    """Identify exercise stub lines without a match in the aligned solution.
+
+    The stub and solution lines are first aligned in order with difflib, and
+    only the stub lines in each unaligned gap are fuzzy matched, against the
+    solution lines in the same gap. This is fast when the cells mostly agree,
+    and a stub line cannot match a distant line of the solution.
+
+    """
+    matcher = difflib.SequenceMatcher(None, stub_lines, solu_lines, autojunk=False)
+    unmatched = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag in ("replace", "delete"):
+            unmatched.extend(unmatched_lines(stub_lines[i1:i2], solu_lines[j1:j2]))
+    return unmatched
+
+
+def test_aligned_unmatched_lines():
+
+    solu_lines = ["x = np.arange(10)", "y = x ** 2", "ax.plot(x, y)", "ax.legend()"]
+    stub_lines = ["x = np.arange(10)", "y = ...", "ax.plot(..., ...)", "ax.legend()"]
+    assert aligned_unmatched_lines(stub_lines, solu_lines) == []
+
+    # Out of order lines are matched by unmatched_lines but not when aligned
+    stub_lines = ["x = np.arange(10)", "ax.plot(x, y)", "y = x ** 2", "ax.legend()"]
+    assert unmatched_lines(stub_lines, solu_lines) == []
+    assert aligned_unmatched_lines(stub_lines, solu_lines) == [(0, "y = x ** 2", "")]
+
+
 def skip_code(line):
     """Return True if a code line should be skipped based on contents."""
     line = dedent(line)
@@ -252,6 +525,31 @@ def parse_args(arglist):
         default="",
         help="Will exit cleanly if message contains 'skip verify'",
     )
+    parser.add_argument(
+        "--jobs", "-j",
+        type=int,
+        default=1,
+        help="Number of notebooks to verify in parallel.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        dest="cache_dir",
+        help="Directory for caching results by exercise and solution source, "
+             "so that only changed exercises are verified again.",
+    )
+    parser.add_argument(
+        "--json",
+        help="Also write per-exercise scores and timing to this JSON file",
+    )
+    parser.add_argument(
+        "--junit",
+        help="Also write a JUnit XML report with a test case per exercise",
+    )
+    parser.add_argument(
+        "--align",
+        action="store_true",
+        help="Align exercise and solution lines in order before fuzzy matching",
+    )
     return parser.parse_args(arglist)
 
 
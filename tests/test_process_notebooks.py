@@ -1,5 +1,14 @@
+import os
+import json
+import zlib
+import base64
+import struct
+import threading
+from functools import partial
 from subprocess import run
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 from pytest import fixture
+import nbformat
 
 
 @fixture
@@ -7,6 +16,15 @@ def cmd():
     return ["python", "scripts/process_notebooks.py"]
 
 
+def write_notebook(path, cells, **metadata):
+    """Write a notebook with a python3 kernelspec (and other metadata) to path."""
+    nb = nbformat.v4.new_notebook(cells=cells)
+    nb.metadata["kernelspec"] = {"name": "python3", "language": "python"}
+    nb.metadata.update(metadata)
+    nbformat.write(nb, path)
+    return nb
+
+
 def test_raises_not_implemented_error(cmd):
 
     nb = "tutorials/raises_notimplemented_error.ipynb"
@@ -27,6 +45,21 @@ def test_raises_name_error(cmd):
     assert "NameError" in res.stderr.decode("utf-8")
 
 
+def test_preflight_name_error(cmd):
+
+    nb = "tutorials/raises_name_error.ipynb"
+    cmdline = cmd + ["--check-only", "--execute", "--preflight", nb]
+    res = run(cmdline, capture_output=True)
+    assert res.returncode
+    assert "Executing" not in res.stdout.decode("utf-8")
+    assert "name 'np' is not defined (cell 0, line 1)" in res.stderr.decode("utf-8")
+
+    nb = "tutorials/raises_notimplemented_error.ipynb"
+    cmdline = cmd + ["--check-only", "--execute", "--preflight", nb]
+    res = run(cmdline, capture_output=True)
+    assert not res.returncode
+
+
 def test_executed_out_of_order(cmd):
 
     nb = "tutorials/executed_out_of_order.ipynb"
@@ -64,3 +97,556 @@ def test_executed_successfully(cmd):
     res = run(cmdline, capture_output=True)
     assert not res.returncode
     assert nb in res.stdout.decode("utf-8")
+
+
+def test_parallel_jobs(cmd):
+
+    nb_ok = "tutorials/raises_notimplemented_error.ipynb"
+    nb_err = "tutorials/raises_name_error.ipynb"
+    cmdline = cmd + ["--check-only", "--execute", "--jobs", "2", nb_ok, nb_err]
+    res = run(cmdline, capture_output=True)
+    assert res.returncode
+    assert nb_ok in res.stdout.decode("utf-8")
+    assert nb_ok not in res.stderr.decode("utf-8")
+    assert nb_err in res.stderr.decode("utf-8")
+    assert "NameError" in res.stderr.decode("utf-8")
+
+
+def test_parallel_raise_fast(cmd, tmp_path):
+
+    nb_slow = tmp_path / "slow.ipynb"
+    write_notebook(nb_slow, [nbformat.v4.new_code_cell("import time\ntime.sleep(120)")])
+    nb_err = "tutorials/raises_name_error.ipynb"
+    cmdline = cmd + [
+        "--check-only", "--execute", "--raise-fast", "--jobs", "2", str(nb_slow), nb_err
+    ]
+    kernels = running_kernels()
+    res = run(cmdline, capture_output=True, timeout=60)
+    assert res.returncode
+    assert "NameError" in res.stderr.decode("utf-8")
+
+    # The kernel running the slow notebook was killed with its worker
+    assert running_kernels() <= kernels
+
+
+def running_kernels():
+    """Return the process IDs of running IPython kernels."""
+    ps = run(["ps", "-eo", "pid=,args="], capture_output=True)
+    return {
+        line.split()[0] for line in ps.stdout.decode("utf-8").splitlines()
+        if "ipykernel_launcher" in line
+    }
+
+
+def test_execution_cache(cmd, tmp_path):
+
+    nb = "tutorials/raises_notimplemented_error.ipynb"
+    cmdline = cmd + ["--check-only", "--execute", "--cache-dir", str(tmp_path), nb]
+    res = run(cmdline, capture_output=True)
+    assert not res.returncode
+    assert f"Executing {nb}" in res.stdout.decode("utf-8")
+    assert list(tmp_path.glob("*.json"))
+
+    res = run(cmdline, capture_output=True)
+    assert not res.returncode
+    assert f"Using cached execution of {nb}" in res.stdout.decode("utf-8")
+
+    # Options that change the outputs do not reuse the cached execution
+    res = run(cmdline + ["--max-stream-chars", "1000"], capture_output=True)
+    assert not res.returncode
+    assert f"Executing {nb}" in res.stdout.decode("utf-8")
+
+    # Nor do cell tags, which can decide whether an error is allowed
+    nb_path = tmp_path / "tagged.ipynb"
+    cell = nbformat.v4.new_code_cell(
+        "raise RuntimeError", metadata={"tags": ["raises-exception"]}
+    )
+    write_notebook(nb_path, [cell])
+    cmdline = cmd + ["--check-only", "--execute", "--cache-dir", str(tmp_path)]
+    res = run(cmdline + [str(nb_path)], capture_output=True)
+    assert not res.returncode, res.stderr.decode("utf-8")
+
+    cell.metadata["tags"] = []
+    write_notebook(nb_path, [cell])
+    res = run(cmdline + [str(nb_path)], capture_output=True)
+    assert res.returncode
+    assert "Using cached execution" not in res.stdout.decode("utf-8")
+
+
+def test_execution_profile(cmd, tmp_path):
+
+    nb = "tutorials/raises_notimplemented_error.ipynb"
+    profile = tmp_path / "profile.json"
+    cmdline = cmd + ["--check-only", "--execute", "--profile", str(profile), nb]
+    res = run(cmdline, capture_output=True)
+    assert not res.returncode
+    assert "Slowest cells" in res.stdout.decode("utf-8")
+    assert f"s CPU  {nb}" in res.stdout.decode("utf-8")
+
+    rows = json.loads(profile.read_text())
+    assert len(rows) == 1
+    assert rows[0]["notebook"] == nb
+    assert rows[0]["wall_time"] >= 0
+
+
+def test_timings(cmd, tmp_path):
+
+    nb_ok = "tutorials/raises_notimplemented_error.ipynb"
+    nb_err = "tutorials/raises_name_error.ipynb"
+    timings = tmp_path / "timings.json"
+    cmdline = cmd + ["--check-only", "--execute", "--timings", str(timings)]
+    res = run(cmdline + [nb_ok, nb_err], capture_output=True)
+    assert res.returncode
+
+    # Failed (partial) runs would understate the runtime, so are not recorded
+    assert list(json.loads(timings.read_text())) == [nb_ok]
+
+    res = run(cmdline + ["--shard", "3/2", nb_ok], capture_output=True)
+    assert res.returncode == 2
+    assert "shard index must be between 1 and 2" in res.stderr.decode("utf-8")
+
+
+def test_select_notebooks_shard():
+
+    nbs = [
+        "tutorials/executed_successfully.ipynb",
+        "tutorials/raises_name_error.ipynb",
+        "tutorials/raises_notimplemented_error.ipynb",
+    ]
+    selected = []
+    for shard in ["1/2", "2/2"]:
+        cmdline = ["python", "scripts/select_notebooks.py", "--shard", shard, *nbs]
+        res = run(cmdline, capture_output=True)
+        assert not res.returncode, res.stderr.decode("utf-8")
+        selected.extend(res.stdout.decode("utf-8").split())
+    assert sorted(selected) == nbs
+
+    cmdline = ["python", "scripts/select_notebooks.py", "--shard", "0/2", *nbs]
+    res = run(cmdline, capture_output=True)
+    assert res.returncode == 2
+    assert "usage" in res.stderr.decode("utf-8")
+
+
+def test_kernel_prelude(cmd, tmp_path):
+
+    nb = "tutorials/raises_name_error.ipynb"
+    cmdline = cmd + ["--check-only", "--execute", "--kernel-prelude", "json", nb]
+    res = run(cmdline, capture_output=True)
+    assert res.returncode
+    assert nb in res.stderr.decode("utf-8")
+    assert "NameError" in res.stderr.decode("utf-8")
+
+    # The kernel was forked with the prelude (which a kernel does not import)
+    nb_path = tmp_path / "prelude.ipynb"
+    write_notebook(nb_path, [
+        nbformat.v4.new_code_cell("import sys\nassert 'wave' in sys.modules"),
+    ])
+    cmdline = cmd + ["--check-only", "--execute", str(nb_path)]
+    res = run(cmdline, capture_output=True)
+    assert res.returncode
+    res = run(cmdline + ["--kernel-prelude", "wave"], capture_output=True)
+    assert not res.returncode, res.stderr.decode("utf-8")
+
+
+def test_skip_widgets(cmd, tmp_path):
+
+    nb_path = tmp_path / "widgets.ipynb"
+    video_output = nbformat.v4.new_output("display_data", {"text/plain": "<video>"})
+    write_notebook(nb_path, [
+        nbformat.v4.new_code_cell("# @title Video 1: Intro\nraise RuntimeError",
+                                  outputs=[video_output]),
+        nbformat.v4.new_code_cell("# @title Helper functions\na = 1"),
+        nbformat.v4.new_code_cell("raise RuntimeError", metadata={"tags": ["network"]}),
+    ])
+
+    cmdline = cmd + ["--check-only", "--execute", str(nb_path)]
+    res = run(cmdline, capture_output=True)
+    assert res.returncode
+
+    cmdline = cmd + [
+        "--check-only", "--execute", "--skip-widgets", "--skip-tag", "network",
+        "--preflight", str(nb_path),
+    ]
+    res = run(cmdline, capture_output=True)
+    assert not res.returncode, res.stderr.decode("utf-8")
+
+
+def test_parameters_override(cmd, tmp_path):
+
+    nb_path = tmp_path / "training.ipynb"
+    write_notebook(nb_path, [
+        nbformat.v4.new_code_cell("n_epochs = 100", metadata={"tags": ["parameters"]}),
+        nbformat.v4.new_code_cell("assert n_epochs == 1"),
+    ])
+
+    cmdline = cmd + ["--execute", "-P", "n_epochs=1", str(nb_path)]
+    res = run(cmdline, capture_output=True)
+    assert not res.returncode, res.stderr.decode("utf-8")
+
+    # The written notebook keeps the authored values
+    nb = nbformat.read(nb_path, as_version=4)
+    assert [cell.source for cell in nb.cells] == ["n_epochs = 100", "assert n_epochs == 1"]
+
+
+def test_download_cache(cmd, tmp_path):
+
+    upstream = tmp_path / "upstream"
+    upstream.mkdir()
+    (upstream / "spikes.csv").write_text("0,1,1,0")
+    handler = partial(SimpleHTTPRequestHandler, directory=upstream)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/spikes.csv"
+
+    nb_path = tmp_path / "download.ipynb"
+    write_notebook(nb_path, [
+        nbformat.v4.new_code_cell(
+            f"from urllib.request import urlopen\n"
+            f"assert urlopen('{url}').read() == b'0,1,1,0'"
+        ),
+        nbformat.v4.new_code_cell(
+            f"try:\n"
+            f"    import requests\n"
+            f"except ImportError:\n"
+            f"    pass\n"
+            f"else:\n"
+            f"    assert requests.get('{url}').text == '0,1,1,0'"
+        ),
+    ])
+
+    cache = tmp_path / "cache"
+    cmdline = cmd + ["--check-only", "--execute", "--download-cache", str(cache)]
+    try:
+        res = run(cmdline + [str(nb_path)], capture_output=True)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert not res.returncode, res.stderr.decode("utf-8")
+    assert len(list((cache / "objects").iterdir())) == 1
+
+    # With upstream gone, kernels (including forked ones) read from the cache
+    for extra in [[], ["--kernel-prelude", "json"]]:
+        res = run(cmdline + extra + [str(nb_path)], capture_output=True)
+        assert not res.returncode, res.stderr.decode("utf-8")
+
+    # The environment's own sitecustomize still runs in the kernel
+    site = tmp_path / "site"
+    site.mkdir()
+    (site / "sitecustomize.py").write_text("import os\nos.environ['NMA_SITE'] = '1'")
+    write_notebook(nb_path, [nbformat.v4.new_code_cell(
+        "import os\nassert os.environ.get('NMA_SITE') == '1'"
+    )])
+    env = {**os.environ, "PYTHONPATH": str(site)}
+    res = run(cmdline + [str(nb_path)], capture_output=True, env=env)
+    assert not res.returncode, res.stderr.decode("utf-8")
+
+
+def test_wheelhouse(cmd, tmp_path):
+
+    nb_path = tmp_path / "install.ipynb"
+    write_notebook(nb_path, [
+        nbformat.v4.new_code_cell("%pip install -q nbformat 'pyflakes>=0.1'"),
+        nbformat.v4.new_code_cell("!pip install --quiet nbformat"),
+        nbformat.v4.new_code_cell("%pip install nma-package-not-in-wheelhouse"),
+    ])
+
+    wheelhouse = tmp_path / "wheelhouse"
+    wheelhouse.mkdir()
+    cmdline = cmd + ["--execute", "--wheelhouse", str(wheelhouse), str(nb_path)]
+    res = run(cmdline, capture_output=True)
+    assert not res.returncode, res.stderr.decode("utf-8")
+
+    nb = nbformat.read(nb_path, as_version=4)
+    outputs = [
+        "".join(output.get("text", "") for output in cell.outputs) for cell in nb.cells
+    ]
+    assert outputs[0].startswith("Skipping pip install")
+    assert outputs[1].startswith("Skipping pip install")
+    assert "No matching distribution" in outputs[2]
+
+
+def test_hang_timeout(cmd, tmp_path):
+
+    nb_path = tmp_path / "hangs.ipynb"
+    write_notebook(nb_path, [
+        nbformat.v4.new_code_cell("import threading"),
+        nbformat.v4.new_code_cell("threading.Event().wait()"),
+    ])
+
+    cmdline = cmd + ["--check-only", "--execute", "--hang-timeout", "2", str(nb_path)]
+    res = run(cmdline, capture_output=True, timeout=60)
+    assert res.returncode
+    stderr = res.stderr.decode("utf-8")
+    assert "Cell 1 hung" in stderr
+    assert "threading.Event().wait()" in stderr
+    assert "Kernel stacks:" in stderr and "in wait" in stderr
+
+
+def test_resource_budgets(cmd, tmp_path):
+
+    nb_path = tmp_path / "greedy.ipynb"
+    nb = write_notebook(nb_path, [
+        nbformat.v4.new_code_cell("import time"),
+        nbformat.v4.new_code_cell("data = bytearray(300 * 2 ** 20)\ntime.sleep(3)"),
+        nbformat.v4.new_code_cell("start = time.process_time()\nwhile True: pass"),
+    ])
+
+    cmdline = cmd + ["--check-only", "--execute", "--max-memory", "200", str(nb_path)]
+    res = run(cmdline, capture_output=True, timeout=60)
+    assert res.returncode
+    assert "Cell 1 went over the memory budget" in res.stderr.decode("utf-8")
+
+    nb.cells[1].source = "data = bytearray(10)"
+    nbformat.write(nb, nb_path)
+    cmdline = cmd + ["--check-only", "--execute", "--max-cpu-time", "3", str(nb_path)]
+    res = run(cmdline, capture_output=True, timeout=60)
+    assert res.returncode
+    assert "Cell 2 went over the CPU time budget" in res.stderr.decode("utf-8")
+
+
+def test_pin_cpus(cmd, tmp_path):
+
+    nb_path = tmp_path / "threads.ipynb"
+    source = (
+        "import os\n"
+        "n = len(os.sched_getaffinity(0))\n"
+        "assert os.environ['OMP_NUM_THREADS'] == str(n)\n"
+        "from threadpoolctl import threadpool_info\n"
+        "assert all(pool['num_threads'] <= n for pool in threadpool_info())"
+    )
+    write_notebook(nb_path, [nbformat.v4.new_code_cell(source)])
+    write_notebook(
+        tmp_path / "one_thread.ipynb",
+        [nbformat.v4.new_code_cell(source + "\nassert n == 1")],
+        nmaci={"threads": 1},
+    )
+
+    cmdline = cmd + [
+        "--check-only", "--execute", "--pin-cpus", "--jobs", "2",
+        str(nb_path), str(tmp_path / "one_thread.ipynb"),
+    ]
+    # Forked kernels have imported numpy before the thread counts were set
+    for extra in [[], ["--kernel-prelude", "numpy"]]:
+        res = run(cmdline + extra, capture_output=True)
+        assert not res.returncode, res.stderr.decode("utf-8")
+
+    # Pinning only applies to execution, so static checks ignore it
+    cmdline = cmd + ["--check-only", "--check-execution", "--pin-cpus", str(nb_path)]
+    res = run(cmdline, capture_output=True)
+    assert "AttributeError" not in res.stderr.decode("utf-8")
+
+
+def test_stream_limits(cmd, tmp_path):
+
+    nb_path = tmp_path / "training.ipynb"
+    png = make_png(4, 4)
+    write_notebook(nb_path, [
+        nbformat.v4.new_code_cell(
+            "from IPython.display import Image\n"
+            "for i in range(5000):\n"
+            "    print(i, flush=True)\n"
+            "    if i == 2500:\n"
+            f"        display(Image(data={png!r}))"
+        ),
+        nbformat.v4.new_code_cell(
+            "for i in range(1000):\n"
+            "    print(f'\\r{i}', end='', flush=True)"
+        ),
+        nbformat.v4.new_code_cell(
+            "print('x' * 5000)\nraise RuntimeError('expected')",
+            metadata={"tags": ["raises-exception"]},
+        ),
+    ])
+
+    cmdline = cmd + [
+        "--execute", "--coalesce-streams", "--max-stream-chars", "1000", str(nb_path)
+    ]
+    res = run(cmdline, capture_output=True)
+    assert not res.returncode, res.stderr.decode("utf-8")
+
+    nb = nbformat.read(nb_path, as_version=4)
+    outputs = nb.cells[0].outputs
+    assert [out.output_type for out in outputs] == ["stream", "display_data", "stream"]
+    text = "".join(out.text for out in outputs if out.output_type == "stream")
+    assert text.startswith("0\n1\n") and text.endswith("4998\n4999\n")
+    assert "characters of output omitted" in text
+    assert len(text) < 1100
+
+    assert [out.text for out in nb.cells[1].outputs] == ["999"]
+    assert nb.cells[2].outputs[-1].output_type == "error"
+
+
+def test_stream_limits_display_updates(cmd, tmp_path):
+
+    nb_path = tmp_path / "displays.ipynb"
+    write_notebook(nb_path, [
+        nbformat.v4.new_code_cell(
+            "for i in range(5):\n"
+            "    print('x' * 1000)\n"
+            "    display(i, display_id=str(i))"
+        ),
+        nbformat.v4.new_code_cell(
+            "from IPython.display import update_display\n"
+            "update_display(40, display_id='4')"
+        ),
+    ])
+
+    cmdline = cmd + ["--execute", "--max-stream-chars", "1000", str(nb_path)]
+    res = run(cmdline, capture_output=True)
+    assert not res.returncode, res.stderr.decode("utf-8")
+
+    nb = nbformat.read(nb_path, as_version=4)
+    displays = [
+        out.data["text/plain"] for out in nb.cells[0].outputs
+        if out.output_type == "display_data"
+    ]
+    assert displays == ["0", "1", "2", "3", "40"]
+    assert all(out.get("text", True) for out in nb.cells[0].outputs)
+
+    # Merging streams must not shift the outputs that display IDs point at
+    write_notebook(nb_path, [
+        nbformat.v4.new_code_cell(
+            "print('a'); display(1, display_id='x')\n"
+            "print('b'); display(2, display_id='y')\n"
+            "3"
+        ),
+        nbformat.v4.new_code_cell(
+            "from IPython.display import update_display\n"
+            "update_display(20, display_id='y')"
+        ),
+    ])
+    res = run(cmd + ["--execute", "--coalesce-streams", str(nb_path)], capture_output=True)
+    assert not res.returncode, res.stderr.decode("utf-8")
+
+    nb = nbformat.read(nb_path, as_version=4)
+    outputs = nb.cells[0].outputs
+    assert [out.output_type for out in outputs] == [
+        "stream", "display_data", "stream", "display_data", "execute_result"
+    ]
+    assert [out.get("text") or out.data["text/plain"] for out in outputs] == [
+        "a\n", "1", "b\n", "20", "3"
+    ]
+
+
+def test_checkpoint_resume(cmd, tmp_path):
+
+    nb_path = tmp_path / "sections.ipynb"
+    nb = write_notebook(nb_path, [
+        nbformat.v4.new_code_cell("a = 41"),
+        nbformat.v4.new_markdown_cell("# Section 2"),
+        nbformat.v4.new_code_cell("print(a + 1)"),
+    ])
+
+    checkpoints = tmp_path / "checkpoints"
+    requirements = tmp_path / "requirements.txt"
+    requirements.write_text("numpy\n")
+    cmdline = cmd + [
+        "--check-only", "--execute", "--checkpoint-dir", str(checkpoints),
+        "--cache-dep", str(requirements), str(nb_path),
+    ]
+    res = run(cmdline, capture_output=True)
+    assert not res.returncode
+    assert "Resuming" not in res.stdout.decode("utf-8")
+    assert len(list(checkpoints.glob("*.pkl"))) == 1
+
+    # Changing code after the checkpoint still resumes, using the saved state
+    nb.cells[2].source = "assert a == 41"
+    nbformat.write(nb, nb_path)
+    res = run(cmdline, capture_output=True)
+    assert not res.returncode
+    assert "Resuming execution from checkpoint before cell 1" in res.stdout.decode("utf-8")
+
+    # Changing dependencies or tags before it invalidates the checkpoint
+    requirements.write_text("numpy>=2\n")
+    res = run(cmdline, capture_output=True)
+    assert not res.returncode
+    assert "Resuming" not in res.stdout.decode("utf-8")
+
+    nb.cells[0].metadata["tags"] = ["setup"]
+    nbformat.write(nb, nb_path)
+    res = run(cmdline, capture_output=True)
+    assert not res.returncode
+    assert "Resuming" not in res.stdout.decode("utf-8")
+
+    # Changing code before it invalidates the checkpoint
+    nb.cells[0].source = "a = 40"
+    nbformat.write(nb, nb_path)
+    res = run(cmdline, capture_output=True)
+    assert res.returncode
+    assert "Resuming" not in res.stdout.decode("utf-8")
+
+
+def make_png(width, height, dpi=None):
+    """Build a minimal grayscale PNG, optionally with a pHYs (DPI) chunk."""
+    def chunk(kind, data):
+        body = kind + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)
+    rows = b"".join(b"\x00" + b"\xff" * width for _ in range(height))
+    png = b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr)
+    if dpi is not None:
+        ppm = round(dpi / 0.0254)
+        png += chunk(b"pHYs", struct.pack(">IIB", ppm, ppm, 1))
+    return png + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b"")
+
+
+@fixture
+def tutorial(tmp_path):
+    """Write an executed tutorial notebook with an exercise and a solution."""
+    png = base64.b64encode(make_png(40, 20, dpi=144)).decode("ascii")
+    cells = [
+        nbformat.v4.new_code_cell(
+            "def exercise():\n    raise NotImplementedError\n    return ...",
+            execution_count=1,
+        ),
+        nbformat.v4.new_code_cell(
+            "# to_remove solution\ndef exercise():\n    return 1",
+            execution_count=2,
+            outputs=[nbformat.v4.new_output("display_data", {"image/png": png})],
+        ),
+    ]
+    nb_dir = tmp_path / "tutorials" / "W1D1_Test"
+    nb_dir.mkdir(parents=True)
+    nbformat.write(nbformat.v4.new_notebook(cells=cells), nb_dir / "W1D1_Tutorial1.ipynb")
+    return tmp_path, "tutorials/W1D1_Test/W1D1_Tutorial1.ipynb"
+
+
+def test_post_processing_skips_unchanged(cmd, tutorial):
+
+    root, nb = tutorial
+    executed = (root / nb).read_bytes()
+    cmdline = [cmd[0], os.path.abspath(cmd[1]), nb]
+    res = run(cmdline, capture_output=True, cwd=root)
+    assert not res.returncode, res.stderr.decode("utf-8")
+    assert "skipped 0 unchanged" in res.stdout.decode("utf-8")
+    nb_dir = root / "tutorials" / "W1D1_Test"
+    assert len(list((nb_dir / "static").glob("*.png"))) == 1
+    assert len(list((nb_dir / "solutions").glob("*.py"))) == 1
+
+    # Outputs of tutorials are cleared, so only the executed original changes
+    (root / nb).write_bytes(executed)
+    res = run(cmdline, capture_output=True, cwd=root)
+    assert not res.returncode, res.stderr.decode("utf-8")
+    assert "Wrote 1 file(s), skipped 4 unchanged" in res.stdout.decode("utf-8")
+
+
+def test_fast_render(cmd, tutorial):
+
+    root, nb = tutorial
+    nb_path = root / nb
+    tutorial_nb = nbformat.read(nb_path, as_version=4)
+    formatter = "get_ipython().display_formatter.formatters['image/png']"
+    tutorial_nb.cells.insert(0, nbformat.v4.new_code_cell(f"assert not {formatter}.enabled"))
+    tutorial_nb.cells[-1].source += (
+        f"\nassert {formatter}.enabled"
+        f"\nfrom IPython.display import Image"
+        f"\ndisplay(Image(data={make_png(40, 20)!r}))"
+    )
+    write_notebook(nb_path, tutorial_nb.cells)
+
+    cmdline = [cmd[0], os.path.abspath(cmd[1]), "--execute", "--fast-render", nb]
+    res = run(cmdline, capture_output=True, cwd=root)
+    assert not res.returncode, res.stderr.decode("utf-8")
+    static_dir = root / "tutorials" / "W1D1_Test" / "static"
+    assert len(list(static_dir.glob("*.png"))) == 1